@@ -0,0 +1,150 @@
+"""Local stand-ins for OpenWeatherMap, Nominatim and an SMTP server with configurable latency and failure rates."""
+
+import json
+import random
+import socketserver
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+def zip_location(zipcode: int) -> tuple:
+    """Deterministic coordinates that lay consecutive zipcodes out on a ~3.5 mile grid."""
+    return 30 + (zipcode % 100) * 0.05, -100 + (zipcode // 100 % 100) * 0.05
+
+
+class Fake:
+    """Shared knobs and counters for a fake upstream."""
+
+    def __init__(self, latency: float = 0.0, failure_rate: float = 0.0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        self.server = None
+
+    def count(self, key: str):
+        with self.lock:
+            self.calls[key] += 1
+
+    def delay(self) -> bool:
+        """Sleeps for the configured latency and returns True if this call should fail."""
+        if self.latency:
+            time.sleep(self.latency)
+        return random.random() < self.failure_rate
+
+    @property
+    def port(self) -> int:
+        return self.server.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FakeHTTP(Fake):
+    def __init__(self, latency: float = 0.0, failure_rate: float = 0.0):
+        super().__init__(latency, failure_rate)
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                parsed = urlparse(self.path)
+                fake.count(parsed.path)
+                if fake.delay():
+                    fake.count("errors")
+                    return self.reply(503, {"message": "injected failure"})
+                self.reply(200, fake.respond(parsed.path, parse_qs(parsed.query)))
+
+            def reply(self, status: int, payload):
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+
+    def respond(self, path: str, query: dict):
+        raise NotImplementedError
+
+
+class FakeWeather(FakeHTTP):
+    """Answers /data/2.5/weather, flagging a share of the locations with a severe weather alert."""
+
+    def __init__(self, latency: float = 0.0, failure_rate: float = 0.0, alert_ratio: float = 0.1):
+        super().__init__(latency, failure_rate)
+        self.alert_ratio = alert_ratio
+
+    def respond(self, path: str, query: dict):
+        latitude, longitude = float(query["lat"][0]), float(query["lon"][0])
+        current = {
+            "name": f"Cell {latitude:.2f},{longitude:.2f}",
+            "weather": [{"description": "scattered clouds"}],
+            "main": {"temp": 71.2, "temp_min": 65.0, "temp_max": 78.4, "feels_like": 70.1},
+        }
+        if random.Random(f"{latitude}{longitude}").random() < self.alert_ratio:
+            current["alerts"] = [{"event": "Severe Thunderstorm Warning", "start": int(time.time()) // 3_600 * 3_600}]
+        return current
+
+
+class FakeGeocoder(FakeHTTP):
+    """Answers Nominatim /search queries for zipcodes with the grid from ``zip_location``."""
+
+    def respond(self, path: str, query: dict):
+        zipcode = int(query["q"][0])
+        latitude, longitude = zip_location(zipcode)
+        return [{"lat": str(latitude), "lon": str(longitude), "display_name": f"{zipcode}, United States"}]
+
+
+class FakeSMTP(Fake):
+    """Minimal SMTP server that accepts every message without AUTH and counts deliveries."""
+
+    def __init__(self, latency: float = 0.0, failure_rate: float = 0.0):
+        super().__init__(latency, failure_rate)
+        fake = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def reply(self, line: str):
+                self.wfile.write(f"{line}\r\n".encode())
+
+            def handle(self):
+                self.reply("220 fake smtp ready")
+                fake.count("connections")
+                while line := self.rfile.readline():
+                    command = line.decode(errors="replace").strip().upper()
+                    if command.startswith(("EHLO", "HELO")):
+                        self.reply("250 fake")
+                    elif command.startswith(("MAIL", "RCPT", "RSET", "NOOP")):
+                        self.reply("250 OK")
+                    elif command == "DATA":
+                        self.reply("354 end with <CRLF>.<CRLF>")
+                        while self.rfile.readline() not in (b".\r\n", b".\n", b""):
+                            pass
+                        if fake.delay():
+                            fake.count("errors")
+                            self.reply("451 injected failure")
+                        else:
+                            fake.count("messages")
+                            self.reply("250 queued")
+                    elif command == "QUIT":
+                        self.reply("221 bye")
+                        return
+                    else:
+                        self.reply("502 not implemented")
+
+        self.server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
@@ -0,0 +1,327 @@
+"""Load and benchmark harness for the WeatherTogether hot paths.
+
+Runs the app against local fakes for OpenWeatherMap, Nominatim and SMTP inside a scratch directory, then reports
+throughput, p50/p99 latency and upstream call counts per scenario::
+
+    python benchmarks/run.py --subscribers 100000 --zipcodes 5000 --output bench.json
+    python benchmarks/run.py --baseline bench.json --tolerance 0.2  # exits 1 on regression
+
+The run also exits 1 if /health's p99 exceeds --health-bound while slow /create-alert requests are in flight.
+
+Email validation in /create-alert still resolves MX records through the system resolver.
+"""
+
+import argparse
+import io
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fakes import FakeGeocoder, FakeSMTP, FakeWeather, zip_location  # noqa: E402
+
+PASSWORD = "bench#1234"
+REPORT_SLOTS = [f"{hour:02d}:{minute:02d} {meridiem}" for meridiem in ("AM", "PM")
+                for hour in range(1, 13) for minute in (0, 30)]
+FREQUENCIES = (None, 5, 15, 30)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--subscribers", type=int, default=100_000)
+    parser.add_argument("--zipcodes", type=int, default=5_000)
+    parser.add_argument("--requests", type=int, default=200, help="requests per HTTP scenario")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--casts", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds added to every upstream call")
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--alert-ratio", type=float, default=0.1)
+    parser.add_argument("--warm-geocode", action="store_true", help="pre-seed zipcode coordinates")
+    parser.add_argument("--email-rate", type=float, default=1_000.0)
+    parser.add_argument("--drain-timeout", type=float, default=60.0)
+    parser.add_argument("--output", help="write results as json")
+    parser.add_argument("--baseline", help="results json to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression")
+    parser.add_argument("--slow-validation", type=float, default=2.0,
+                        help="seconds each /create-alert spends validating email during the health scenario")
+    parser.add_argument("--health-bound", type=float, default=100.0,
+                        help="max p99 ms for /health while slow /create-alert requests are in flight")
+    return parser.parse_args()
+
+
+def summarize(name: str, latencies: list, elapsed: float, upstream: dict) -> dict:
+    latencies = sorted(latencies) or [0.0]
+    return {
+        "scenario": name,
+        "count": len(latencies),
+        "seconds": round(elapsed, 3),
+        "throughput": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": round(statistics.median(latencies) * 1_000, 2),
+        "p99_ms": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1_000, 2),
+        "upstream": upstream,
+    }
+
+
+class Harness:
+    def __init__(self, args):
+        self.args = args
+        self.weather = FakeWeather(args.latency, args.failure_rate, args.alert_ratio).start()
+        self.geocoder = FakeGeocoder(args.latency, args.failure_rate).start()
+        self.smtp = FakeSMTP(args.latency, args.failure_rate).start()
+        self.results = []
+        self.zipcodes = list(range(10_000, 10_000 + args.zipcodes))
+
+    def snapshot(self) -> dict:
+        return {"weather": sum(self.weather.calls.values()), "geocode": sum(self.geocoder.calls.values()),
+                "smtp": self.smtp.calls["messages"]}
+
+    def measure(self, name: str, function, items: list, concurrency: int = 1):
+        """Calls the function once per item and records the latencies."""
+        before, latencies = self.snapshot(), []
+
+        def timed(item):
+            start = time.perf_counter()
+            function(item)
+            latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        if concurrency == 1:
+            for item in items:
+                timed(item)
+        else:
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                list(executor.map(timed, items))
+        elapsed = time.perf_counter() - start
+        after = self.snapshot()
+        result = summarize(name, latencies, elapsed, {key: after[key] - before[key] for key in after})
+        self.results.append(result)
+        print(f"{name:<24} n={result['count']:<7} {result['throughput']:>10.2f}/s  p50={result['p50_ms']:>9.2f}ms  "
+              f"p99={result['p99_ms']:>9.2f}ms  upstream={result['upstream']}", flush=True)
+
+    def configure(self):
+        """Points the app at the fakes; must run before any app module is imported."""
+        os.environ.update({
+            "WEATHER_API": "bench", "EMAIL_USERNAME": "bench@gmail.com", "EMAIL_PASSWORD": "bench",
+            "WEATHER_HOST": f"http://127.0.0.1:{self.weather.port}",
+            "GEOCODER_DOMAIN": f"127.0.0.1:{self.geocoder.port}",
+            "SMTP_HOST": "127.0.0.1", "SMTP_PORT": str(self.smtp.port), "SMTP_STARTTLS": "false",
+            "EMAIL_RATE": str(self.args.email_rate), "WEATHER_RATE": "1000", "GEOCODER_RATE": "1000",
+        })
+
+    def seed(self):
+        from helpers import tokenizer, validators
+        from modules import database
+
+        # signups check the domain's MX records, answered from the cache so runs never depend on the network
+        validators.domain_cache.put("gmail.com")
+
+        password = tokenizer.hex_encode(PASSWORD)
+        rows = [(index, f"user{index}@gmail.com", password, random.choice(self.zipcodes),
+                 random.choice(REPORT_SLOTS), random.choice(FREQUENCIES), True)
+                for index in range(1, self.args.subscribers + 1)]
+        with database.db.connection:
+            database.db.connection.executemany(
+                "INSERT or REPLACE INTO container VALUES (?,?,?,?,?,?,?);", rows
+            )
+            if self.args.warm_geocode:
+                database.db.connection.executemany(
+                    "INSERT or REPLACE INTO coordinates VALUES (?,?,?);",
+                    [(zipcode, *zip_location(zipcode)) for zipcode in self.zipcodes]
+                )
+        return rows
+
+    def background_jobs(self, rows: list):
+        from helpers import bgtasks, support
+        from modules.database import db
+
+        frequencies = sorted({frequency or 30 for frequency in FREQUENCIES})
+        self.measure("send_alert (cold)", bgtasks.send_alert, frequencies)
+        self.measure("send_alert (warm)", bgtasks.send_alert, frequencies)
+        busiest = db.connection.execute(
+            "SELECT report_time FROM container GROUP BY report_time ORDER BY COUNT(*) DESC LIMIT 1"
+        ).fetchone()[0]
+        self.measure("send_report", bgtasks.send_report, [busiest])
+        casts = random.sample(rows, min(self.args.casts, len(rows)))
+        self.measure("crowd_cast", lambda row: support.crowd_cast(row[3], "bench cast", "",
+                                                                   f"http://bench/report/{row[0]}/"), casts)
+
+    def endpoints(self, rows: list):
+        import uvicorn
+        import main
+
+        server = uvicorn.Server(uvicorn.Config(main.app, port=0, log_level="error", lifespan="off"))
+        threading.Thread(target=server.run, daemon=True).start()
+        while not server.started:
+            time.sleep(0.05)
+        base = "http://127.0.0.1:%d" % server.servers[0].sockets[0].getsockname()[1]
+        session = requests.Session()
+        session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=self.args.concurrency))
+        count, concurrency = self.args.requests, self.args.concurrency
+
+        def create_alert(index):
+            session.post(f"{base}/create-alert", data={
+                "email_address": f"new{index}@gmail.com", "password": PASSWORD,
+                "zipcode": random.choice(self.zipcodes), "report_time": "0700"
+            })
+
+        image = io.BytesIO(os.urandom(256 << 10)).getvalue()
+
+        def publish_info(row):
+            session.post(f"{base}/publish-info", data={
+                "email_address": row[1], "password": PASSWORD, "description": "bench", "zipcode": row[3]
+            }, files={"image": ("storm.bin", image)})
+
+        def report(pair):
+            session.get(f"{base}/report/{pair[0]}/{pair[1]}")
+
+        self.measure("POST /create-alert", create_alert, list(range(count)), concurrency)
+        self.measure("POST /publish-info", publish_info, random.sample(rows, min(count, len(rows))), concurrency)
+        pairs = [(random.randint(1, len(rows)), random.randint(1, len(rows))) for _ in range(count)]
+        self.measure("GET /report", report, pairs, concurrency)
+        self.measure("GET /health", lambda _: session.get(f"{base}/health"), list(range(count)), concurrency)
+        self.health_under_load(base, session)
+        server.should_exit = True
+
+    def health_under_load(self, base: str, session):
+        """Times /health while ``concurrency`` /create-alert requests are held open by slow email validation.
+
+        Blocking handlers run on the thread pool, so the event loop must keep answering /health in bounded time.
+        """
+        from helpers import validators
+
+        validate = validators.validate_email_address
+        in_flight = threading.Barrier(self.args.concurrency + 1)
+
+        def slow_validation(email_address):
+            time.sleep(self.args.slow_validation)
+            return validate(email_address)
+
+        def create_alert(index):
+            in_flight.wait()
+            session.post(f"{base}/create-alert", data={
+                "email_address": f"slow{index}@gmail.com", "password": PASSWORD,
+                "zipcode": random.choice(self.zipcodes), "report_time": "0700"
+            })
+
+        validators.validate_email_address = slow_validation
+        try:
+            with ThreadPoolExecutor(max_workers=self.args.concurrency) as executor:
+                pending = [executor.submit(create_alert, index) for index in range(self.args.concurrency)]
+                in_flight.wait()
+                time.sleep(0.2)  # let the posts reach their handlers before timing
+                deadline = time.perf_counter() + self.args.slow_validation * 0.8
+                checks = 0
+                before, latencies = self.snapshot(), []
+                start = time.perf_counter()
+                while time.perf_counter() < deadline:
+                    tick = time.perf_counter()
+                    try:
+                        requests.get(f"{base}/health", timeout=self.args.slow_validation * 2)
+                    except requests.RequestException:
+                        pass  # a stalled event loop shows up as the time spent waiting
+                    latencies.append(time.perf_counter() - tick)
+                    checks += 1
+                elapsed, still_open = time.perf_counter() - start, sum(not future.done() for future in pending)
+                for future in pending:
+                    future.result()
+        finally:
+            validators.validate_email_address = validate
+        after = self.snapshot()
+        result = summarize("GET /health under load", latencies, elapsed,
+                           {key: after[key] - before[key] for key in after})
+        result.update(in_flight=still_open, bound_ms=self.args.health_bound)
+        self.results.append(result)
+        print(f"{'GET /health under load':<24} n={checks:<7} p50={result['p50_ms']:>9.2f}ms  "
+              f"p99={result['p99_ms']:>9.2f}ms  with {still_open} slow /create-alert in flight", flush=True)
+
+    def drain(self):
+        """Starts the mailer and times how long it takes to empty the outbox."""
+        from helpers import mailer
+        from modules import database
+
+        queued = database.db.connection.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+        before, start = self.snapshot(), time.perf_counter()
+        mailer.start()
+        remaining = queued
+        while remaining and time.perf_counter() - start < self.args.drain_timeout:
+            time.sleep(0.5)
+            remaining = database.db.connection.execute(
+                "SELECT COUNT(*) FROM outbox WHERE status!='dead'"
+            ).fetchone()[0]
+        elapsed, after = time.perf_counter() - start, self.snapshot()
+        sent = queued - remaining
+        result = {"scenario": "mailer drain", "count": sent, "seconds": round(elapsed, 3),
+                  "throughput": round(sent / elapsed, 2), "queued": queued, "remaining": remaining,
+                  "upstream": {key: after[key] - before[key] for key in after}}
+        self.results.append(result)
+        print(f"{'mailer drain':<24} sent={sent} of {queued} in {elapsed:.1f}s ({result['throughput']}/s)")
+
+    def run(self):
+        self.configure()
+        os.chdir(tempfile.mkdtemp(prefix="weather-bench-"))
+        print(f"Working directory: {os.getcwd()}", flush=True)
+        start = time.perf_counter()
+        rows = self.seed()
+        print(f"Seeded {len(rows)} subscribers across {len(self.zipcodes)} zipcodes "
+              f"in {time.perf_counter() - start:.1f}s", flush=True)
+        self.background_jobs(rows)
+        self.endpoints(rows)
+        self.drain()
+        for fake in (self.weather, self.geocoder, self.smtp):
+            fake.stop()
+        return self.results
+
+
+def check_bounds(results: list) -> list:
+    """Returns the scenarios that broke an absolute latency bound, independent of any baseline."""
+    return [f"{result['scenario']}: p99 {result['p99_ms']}ms exceeds {result['bound_ms']}ms"
+            for result in results if result.get("bound_ms") and result["p99_ms"] > result["bound_ms"]]
+
+
+def compare(results: list, baseline: list, tolerance: float) -> list:
+    """Returns the scenarios whose p99 latency or throughput regressed beyond the tolerance."""
+    previous = {result["scenario"]: result for result in baseline}
+    regressions = []
+    for result in results:
+        if not (before := previous.get(result["scenario"])):
+            continue
+        if before.get("p99_ms") and result["p99_ms"] > before["p99_ms"] * (1 + tolerance):
+            regressions.append(f"{result['scenario']}: p99 {before['p99_ms']}ms -> {result['p99_ms']}ms")
+        if before.get("throughput") and result["throughput"] < before["throughput"] * (1 - tolerance):
+            regressions.append(f"{result['scenario']}: throughput {before['throughput']}/s -> "
+                               f"{result['throughput']}/s")
+    return regressions
+
+
+def main():
+    args = parse_arguments()
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    output = os.path.abspath(args.output) if args.output else None
+    results = Harness(args).run()
+    if output:
+        with open(output, "w") as file:
+            json.dump(results, file, indent=4)
+    if violations := check_bounds(results):
+        print("Bound violations:\n  " + "\n  ".join(violations))
+        sys.exit(1)
+    if baseline is not None:
+        if regressions := compare(results, baseline, args.tolerance):
+            print("Regressions:\n  " + "\n  ".join(regressions))
+            sys.exit(1)
+        print("No regressions against the baseline")
+
+
+if __name__ == "__main__":
+    main()
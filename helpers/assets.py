@@ -0,0 +1,97 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import threading
+
+from fastapi import Request, Response
+from fastapi.templating import Jinja2Templates
+
+from helpers import metrics
+from modules.accessories import constants
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+templates = Jinja2Templates(directory=constants.ui_dir)
+
+
+class Asset:
+    """Bytes of a file or rendered page with its ETag and any compressed variants worth sending."""
+
+    def __init__(self, body: bytes, media_type: str, cache_control: str):
+        self.media_type = media_type
+        self.cache_control = cache_control
+        digest = hashlib.sha1(body).hexdigest()[:20]
+        self.variants = {"identity": (body, f'"{digest}"')}
+        if compressed := self.compress(body, "gzip"):
+            self.variants["gzip"] = compressed, f'"{digest}-gz"'
+        if compressed := self.compress(body, "br"):
+            self.variants["br"] = compressed, f'"{digest}-br"'
+        self.etags = {etag for _, etag in self.variants.values()}
+
+    @staticmethod
+    def compress(body: bytes, encoding: str):
+        if encoding == "br":
+            compressed = brotli.compress(body) if brotli else None
+        else:
+            compressed = gzip.compress(body, compresslevel=9, mtime=0)
+        # images are already compressed, keep the variant only when it saves something noticeable
+        if compressed and len(compressed) < len(body) * 0.9:
+            return compressed
+
+    def encoding(self, accept_encoding: str) -> str:
+        accepted = {each.split(";")[0].strip() for each in accept_encoding.lower().split(",")}
+        for encoding in ("br", "gzip"):
+            if encoding in self.variants and encoding in accepted:
+                return encoding
+        return "identity"
+
+
+# keyed on (kind, name), since a file and a page can share a name but not their headers
+cache = {}
+lock = threading.Lock()
+
+
+def get_file(name: str):
+    """Returns the cached asset for a file in the UI directory, reading it only on first use."""
+    if asset := cache.get(("file", name)):
+        return asset
+    path = os.path.join(constants.ui_dir, name)
+    if os.path.basename(name) != name or not os.path.isfile(path):
+        return
+    with open(path, "rb") as file:
+        body = file.read()
+    asset = Asset(body, mimetypes.guess_type(name)[0] or "application/octet-stream",
+                  f"public, max-age={constants.asset_max_age}")
+    with lock:
+        return cache.setdefault(("file", name), asset)
+
+
+def get_page(name: str) -> Asset:
+    """Returns the page rendered once from a template, none of which depend on the request."""
+    if asset := cache.get(("page", name)):
+        return asset
+    body = templates.get_template(name).render().encode()
+    # pages are revalidated on every view so a deployment shows up immediately, the ETag keeps that cheap
+    asset = Asset(body, "text/html; charset=utf-8", "no-cache")
+    with lock:
+        return cache.setdefault(("page", name), asset)
+
+
+def respond(request: Request, asset: Asset) -> Response:
+    """Answers with 304 when the client's copy is current, otherwise with the best encoding it accepts."""
+    encoding = asset.encoding(request.headers.get("accept-encoding", ""))
+    body, etag = asset.variants[encoding]
+    headers = {"ETag": etag, "Cache-Control": asset.cache_control, "Vary": "Accept-Encoding"}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or
+                          asset.etags & {each.strip().removeprefix("W/") for each in if_none_match.split(",")}):
+        metrics.inc("asset_responses_total", result="not_modified")
+        return Response(status_code=304, headers=headers)
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    metrics.inc("asset_responses_total", result="sent", encoding=encoding)
+    return Response(content=body, media_type=asset.media_type, headers=headers)
@@ -1,87 +1,207 @@
+import hashlib
+import heapq
 import json
 import os
+import socket
 import string
+import threading
 import time
-from datetime import datetime
+from datetime import datetime, timedelta
+from queue import Empty
 
+from helpers import mailer, metrics
 from helpers.log import logger
-from helpers.support import email_object
-from helpers.weather import get_weather
-from modules.database import get_existing_info
-
-
-def send_alert():
-    info = get_existing_info()
-    if not info:
-        logger.warning("No information in DB")
-        return
-    weather_info = {"last_updated_time": datetime.now().strftime("%c")}
-    for each in info:
-        email_address = each[1]
-        zipcode = each[3]
-        current = get_weather(zipcode)
-        if current.get("alerts"):
-            response = email_object.send_email(recipient=email_address,
-                                               subject=f"Welcome to WeatherTogether {datetime.now().strftime('%c')}",
-                                               sender="WeatherTogether",
-                                               body="Hi,\n\n"
-                                                    "Currently you have a severe weather warning near your area code: "
-                                                    f"{zipcode}\n\n"
-                                                    f"{current['alerts']}")
-            if response.ok:
-                logger.info("weather warning has been sent to %s", email_address)
-            else:
-                logger.error(response.body)
-    with open("weather_file.json", "w") as file:
-        json.dump(weather_info, file, indent=4)
-
-
-def send_report():
-    info = get_existing_info()
-    if not info:
-        logger.warning("No information in DB")
-        return
-    for each in info:
-        email_address = each[1]
-        zipcode = each[3]
-        report_time = each[4]
-        if report_time == datetime.now().strftime("%I:%M %p"):
-            current_weather = None
-            if os.path.isfile("weather_file.json"):
-                with open("weather_file.json") as file:
-                    existing_weather = json.load(file)
-                if existing_weather.get(zipcode):
-                    current_weather = existing_weather[zipcode]
-            if current_weather is None:
-                current_weather = get_weather(zipcode)
-            city = current_weather.get('name', zipcode)
-            desc = current_weather.get('weather', [{}])[0].get('description')
-            temp = current_weather.get('main', {}).get('temp')
-            temp_min = current_weather.get('main', {}).get('temp_min')
-            temp_max = current_weather.get('main', {}).get('temp_max')
-            feels_like = current_weather.get('main', {}).get('feels_like')
-            text = f"Current weather forecast for {city}:\n\n{string.capwords(desc)} with " \
-                   f"current temperature of {temp} \N{DEGREE SIGN}F. " \
-                   f"The high is {temp_max} \N{DEGREE SIGN}F, and the low is {temp_min} \N{DEGREE SIGN}F." \
-                   f" It currently feels like {feels_like} \N{DEGREE SIGN}F."
-            response = email_object.send_email(recipient=email_address,
-                                               subject=f"Weather Report - {datetime.now().strftime('%c')}",
-                                               sender="WeatherTogether", body=text)
-            if response.ok:
-                logger.info("weather report email has been sent")
+from helpers.weather import get_weather_many, weather_cache
+from modules.accessories import constants, schedule_queue
+from modules.database import (get_alert_zipcodes, get_report_zipcodes, get_schedule, acquire_lease,
+                              get_alert_states, put_alert_states, iter_alert_subscribers, iter_report_subscribers)
+
+leader = threading.Event()
+lease = {"expires": 0.0}
+
+REPORT_TEMPLATE = "Current weather forecast for {city}:\n\n" \
+                  "{desc} with current temperature of {temp} \N{DEGREE SIGN}F. " \
+                  "The high is {temp_max} \N{DEGREE SIGN}F, and the low is {temp_min} \N{DEGREE SIGN}F. " \
+                  "It currently feels like {feels_like} \N{DEGREE SIGN}F."
+
+
+def alert_digest(alert: dict) -> str:
+    """Identifies an alert by the fields that stay the same while it is active."""
+    identity = [alert.get(field) for field in ("sender_name", "event", "start", "end", "description")]
+    return hashlib.sha1(json.dumps(identity, default=str).encode()).hexdigest()
+
+
+def send_alert(frequency: int = constants.alert_frequency) -> int:
+    """Emails subscribers only about alerts in their zipcode that have not been sent at this frequency before."""
+    zipcodes = get_alert_zipcodes(frequency)
+    if not zipcodes:
+        logger.warning("No subscribers with an alert frequency of %d minutes", frequency)
+        return 0
+    now = time.time()
+    fetched = {}
+    # half the interval, so the previous check's fetch is never reused but a report's fetch just now can be
+    for zipcode, current in get_weather_many(zipcodes, max_age=frequency * 30).items():
+        for alert in current.get("alerts") or []:
+            # the provider can keep serving an alert for a while after it has ended
+            if (alert.get("end") or now) >= now:
+                fetched[(zipcode, alert_digest(alert))] = alert
+    new = set(fetched) - get_alert_states(frequency, list({zipcode for zipcode, _ in fetched}), now)
+    alerts = {}
+    for zipcode, digest in new:
+        alerts.setdefault(zipcode, []).append(fetched[(zipcode, digest)])
+    logger.info("%d of %d active alert(s) are new", len(new), len(fetched))
+    subject = f"Welcome to WeatherTogether {datetime.now().strftime('%c')}"
+    queued = mailer.enqueue_iter(
+        (email_address, subject, "Hi,\n\nCurrently you have a severe weather warning near your area code: "
+                                 f"{zipcode}\n\n{alerts[zipcode]}", None)
+        for email_address, zipcode in iter_alert_subscribers(frequency, list(alerts), ("email_address", "zipcode"))
+    ) if alerts else 0
+    # recorded only once the emails are in the outbox, so a failed pass sends the same alerts on the next one
+    put_alert_states(frequency, [(zipcode, digest, alert.get("end") or now + constants.alert_expiry)
+                                 for (zipcode, digest), alert in fetched.items()], now)
+    logger.info("%d weather warning(s) queued", queued)
+    weather_cache.save()
+    return len(zipcodes)
+
+
+def render_report(zipcode: int, current_weather: dict) -> str:
+    main = current_weather.get('main', {})
+    description = current_weather.get('weather', [{}])[0].get('description') or ""
+    return REPORT_TEMPLATE.format(city=current_weather.get('name', zipcode), desc=string.capwords(description),
+                                  temp=main.get('temp'), temp_min=main.get('temp_min'), temp_max=main.get('temp_max'),
+                                  feels_like=main.get('feels_like'))
+
+
+def send_report(report_time: str = None) -> int:
+    """Renders one report body per zipcode due at the report time, then streams the recipients to the mailer."""
+    report_time = report_time or datetime.now().strftime("%I:%M %p")
+    zipcodes = get_report_zipcodes(report_time)
+    if not zipcodes:
+        logger.warning("No subscribers with a report time of %s", report_time)
+        return 0
+    bodies = {zipcode: render_report(zipcode, current) for zipcode, current in get_weather_many(zipcodes).items()}
+    subject = f"Weather Report - {datetime.now().strftime('%c')}"
+    queued = mailer.enqueue_iter(
+        (email_address, subject, bodies[zipcode], None)
+        for email_address, zipcode in iter_report_subscribers(report_time, ("email_address", "zipcode"))
+        if zipcode in bodies
+    )
+    logger.info("%d weather report(s) queued for %d zipcodes", queued, len(bodies))
+    weather_cache.save()
+    return len(zipcodes)
+
+
+def next_report(report_time: str, after: datetime) -> datetime:
+    """Returns the first occurrence of the report time after the given datetime."""
+    scheduled = datetime.strptime(report_time, "%I:%M %p")
+    due = after.replace(hour=scheduled.hour, minute=scheduled.minute, second=0, microsecond=0)
+    if due <= after:
+        due += timedelta(days=1)
+    return due
+
+
+def run_scheduler():
+    """Sleeps until the next due report time or alert interval, firing every slot that has come due since.
+
+    Runs for as long as this process holds the scheduler lease.
+    """
+    heap, scheduled = [], set()
+
+    def add_slot(report_time: str, frequency: int):
+        frequency = frequency or constants.alert_frequency
+        if report_time and ("report", report_time) not in scheduled:
+            scheduled.add(("report", report_time))
+            heapq.heappush(heap, (next_report(report_time, datetime.now()).timestamp(), "report", report_time))
+        if ("alert", frequency) not in scheduled:
+            scheduled.add(("alert", frequency))
+            heapq.heappush(heap, (time.time(), "alert", frequency))
+
+    resync = 0
+    while leader.is_set():
+        if time.time() >= resync:
+            # slots created through other workers never reach this process's schedule queue
+            for slot in get_schedule():
+                add_slot(*slot)
+            resync = time.time() + constants.schedule_resync
+            logger.info("Scheduled %d report and alert slots", len(scheduled))
+        while heap and heap[0][0] <= time.time():
+            if time.time() >= lease["expires"]:
+                # the heartbeat has not renewed the lease in time, another worker may already hold it
+                logger.warning("Scheduler lease expired, stepping down")
+                leader.clear()
+                return
+            due, kind, value = heapq.heappop(heap)
+            metrics.set_gauge("scheduler_lag_seconds", time.time() - due, kind=kind)
+            try:
+                with metrics.timer("job_seconds", kind=kind):
+                    if kind == "report":
+                        count = send_report(value)
+                    else:
+                        count = send_alert(value)
+            except Exception as error:
+                logger.exception(error)
+                count = 1
+            if not count:
+                scheduled.discard((kind, value))
+                continue
+            if kind == "report":
+                # reschedule from the due time rather than now, so a long pass cannot skip the slot tomorrow
+                heapq.heappush(heap, (next_report(value, datetime.fromtimestamp(due)).timestamp(), kind, value))
             else:
-                logger.error(response.body)
+                heapq.heappush(heap, (max(due + value * 60, time.time()), kind, value))
+        timeout = min(heap[0][0] if heap else resync, resync, time.time() + constants.lease_ttl / 3) - time.time()
+        try:
+            add_slot(*schedule_queue.get(timeout=max(timeout, 0)))
+        except Empty:
+            pass
+
+
+def heartbeat(holder: str):
+    """Renews the scheduler lease, stepping down if another process has taken it over or renewal fails."""
+    while leader.is_set():
+        time.sleep(constants.lease_ttl / 3)
+        now = time.time()
+        try:
+            renewed = acquire_lease("scheduler", holder, constants.lease_ttl, now)
+        except Exception as error:
+            logger.exception(error)
+            renewed = False
+        if renewed:
+            lease["expires"] = now + constants.lease_ttl
+        else:
+            logger.warning("%s lost the scheduler lease", holder)
+            leader.clear()
+
+
+def discard_schedule(timeout: float):
+    """Drops slots queued while not leading, the leader picks them up from the database on its next resync."""
+    deadline = time.time() + timeout
+    while (remaining := deadline - time.time()) > 0:
+        try:
+            schedule_queue.get(timeout=remaining)
+        except Empty:
+            return
 
 
 def background_task():
-    # todo: Add exception handler
-    alert_start = time.time()
-    report_start = time.time()
-    send_alert()
+    """Runs in every worker, but only the process holding the scheduler lease sends alerts and reports.
+
+    The lease expires if its holder dies, so one of the remaining workers takes over.
+    """
+    holder = f"{socket.gethostname()}:{os.getpid()}"
+    metrics.reset()
+    metrics.start()
     while True:
-        if time.time() - alert_start > 1_800:
-            alert_start = time.time()
-            send_alert()
-        if time.time() - report_start > 30:
-            report_start = time.time()
-            send_report()
+        now = time.time()
+        try:
+            acquired = acquire_lease("scheduler", holder, constants.lease_ttl, now)
+        except Exception as error:
+            logger.exception(error)
+            acquired = False
+        if acquired:
+            logger.info("%s acquired the scheduler lease", holder)
+            lease["expires"] = now + constants.lease_ttl
+            leader.set()
+            threading.Thread(target=heartbeat, args=(holder,), daemon=True).start()
+            run_scheduler()
+        discard_schedule(constants.lease_ttl / 3)
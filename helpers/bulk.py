@@ -0,0 +1,154 @@
+import csv
+import io
+import json
+import tempfile
+import threading
+import time
+
+from fastapi import Request
+
+from helpers import mailer, support, tokenizer, validators
+from helpers.location import zip_index
+from helpers.log import logger
+from modules import database
+from modules.accessories import constants, schedule_queue
+
+EXPORT_COLUMNS = ('userid', 'email_address', 'zipcode', 'report_time', 'frequency', 'crowdsource_button')
+
+
+async def spool(request: Request):
+    """Buffers the upload as it arrives, in memory up to ``constants.import_spool`` bytes and on disk past that."""
+    upload = tempfile.SpooledTemporaryFile(max_size=constants.import_spool)
+    async for chunk in request.stream():
+        upload.write(chunk)
+    upload.seek(0)
+    return upload
+
+
+def read_records(upload, csv_format: bool):
+    """Yields (line number, record or error) pairs from an NDJSON or CSV (with a header row) upload.
+
+    The CSV reader consumes the upload as a stream, so quoted values may span lines.
+    """
+    text = io.TextIOWrapper(upload, encoding="utf-8", errors="replace", newline="")
+    if csv_format:
+        reader, header = csv.reader(text), None
+        for values in reader:
+            if not values:
+                continue
+            if header is None:
+                header = [value.strip() for value in values]
+                continue
+            yield reader.line_num, dict(zip(header, values))
+        return
+    for line_number, line in enumerate(text, start=1):
+        if not (line := line.strip()):
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as error:
+            yield line_number, f"invalid json: {error}"
+            continue
+        yield line_number, record if isinstance(record, dict) else "expected a json object"
+
+
+def parse_bool(value) -> bool:
+    if isinstance(value, str):
+        return value.strip().lower() not in ("", "0", "false", "no", "off")
+    return bool(value)
+
+
+def parse_record(record: dict) -> tuple:
+    """Validates a record the same way /create-alert does and returns it as a row for ``put_subscriptions``."""
+    email_address = str(record["email_address"]).strip()
+    if error := validators.validate_email_address(email_address):
+        raise ValueError(error)
+    password = str(record["password"])
+    if not validators.validate_pw(password):
+        raise ValueError("password is invalid")
+    zipcode = int(record["zipcode"])
+    if not validators.validate_zip(zipcode):
+        raise ValueError(f"zipcode is invalid: {zipcode}. zipcodes must be 5-digit")
+    if not (time_valid := validators.validate_time(str(record["report_time"]).strip())):
+        raise ValueError(f"time is invalid: {record['report_time']}")
+    frequency = record.get("frequency")
+    frequency = int(frequency) if frequency not in (None, "") else None
+    if not validators.validate_frequency(frequency):
+        raise ValueError(f"frequency is invalid: {frequency}")
+    return (email_address, tokenizer.hex_encode(password), zipcode, time_valid.strftime("%I:%M %p"), frequency,
+            parse_bool(record.get("accept_crowd_sourcing", True)))
+
+
+def import_batch(rows: list, blocked: set, summary: dict) -> set:
+    """Writes a batch of rows in a single transaction, queues the welcome emails and returns the zipcodes written."""
+    if not rows:
+        return set()
+    written, new = database.put_subscriptions(rows, blocked, time.time())
+    for slot in {(row[4], row[5]) for row in written}:
+        schedule_queue.put(slot)
+    report_times = {row[1]: row[4] for row in written}
+    summary["welcome_emails"] += mailer.enqueue_iter(support.welcome_email(email_address, report_times[email_address])
+                                                     for email_address in new)
+    summary["imported"] += len(written)
+    summary["new_addresses"] += len(new)
+    summary["blocked"] += len(rows) - len(written)
+    return {row[3] for row in written}
+
+
+def import_subscriptions(records) -> dict:
+    """Validates the records as they are read and writes the valid ones ``constants.import_batch`` at a time.
+
+    Email domains are looked up once per domain through the validators' cache, so a list dominated by a few
+    providers costs a handful of MX lookups.
+    """
+    summary = {"imported": 0, "new_addresses": 0, "welcome_emails": 0, "blocked": 0, "rejected": 0}
+    blocked, rows, errors, zipcodes = support.get_blocked(), [], [], set()
+
+    def reject(line_number: int, error: str):
+        summary["rejected"] += 1
+        if len(errors) < constants.import_errors:
+            errors.append({"line": line_number, "error": error})
+
+    for count, (line_number, record) in enumerate(records, start=1):
+        if count > constants.import_records:
+            reject(line_number, f"imports are limited to {constants.import_records} records, the rest was skipped")
+            break
+        if isinstance(record, str):
+            reject(line_number, record)
+            continue
+        try:
+            rows.append(parse_record(record))
+        except KeyError as error:
+            reject(line_number, f"missing field {error}")
+        except (TypeError, ValueError) as error:
+            reject(line_number, str(error))
+        if len(rows) >= constants.import_batch:
+            zipcodes |= import_batch(rows, blocked, summary)
+            rows = []
+    zipcodes |= import_batch(rows, blocked, summary)
+    if zip_index.loaded and zipcodes:
+        # geocoding is rate limited, so new zipcodes are indexed in the background
+        threading.Thread(target=lambda: [zip_index.add(zipcode) for zipcode in zipcodes], daemon=True).start()
+    logger.info("Imported %d subscriptions (%d new addresses), rejected %d records",
+                summary["imported"], summary["new_addresses"], summary["rejected"])
+    return dict(summary, errors=errors)
+
+
+def export_subscriptions(csv_format: bool):
+    """Streams every subscription without passwords, a page of rows per chunk."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if csv_format:
+        writer.writerow(EXPORT_COLUMNS)
+    count = 0
+    for row in database.iter_subscribers(EXPORT_COLUMNS):
+        if csv_format:
+            writer.writerow(row)
+        else:
+            buffer.write(json.dumps(dict(zip(EXPORT_COLUMNS, row))) + "\n")
+        count += 1
+        if count % constants.page_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
@@ -0,0 +1,55 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi import HTTPException
+from pydantic import PositiveInt
+
+from helpers.log import logger
+from helpers.support import crowd_cast
+from modules.accessories import env, constants
+
+executor = ThreadPoolExecutor(max_workers=env.cast_workers, thread_name_prefix="crowd-cast")
+jobs = OrderedDict()
+lock = threading.Lock()
+
+
+def pending() -> int:
+    return sum(1 for job in jobs.values() if job["status"] in ("queued", "running"))
+
+
+def run(job_id: int, zipcode: PositiveInt, description: str, filename: str, report_url: str):
+    jobs[job_id].update(status="running", started=time.time())
+    try:
+        jobs[job_id]["recipients"] = crowd_cast(zipcode, description, filename, report_url)
+    except Exception as error:
+        logger.exception(error)
+        jobs[job_id].update(status="failed", error=error.__str__())
+    else:
+        jobs[job_id]["status"] = "done"
+    jobs[job_id]["finished"] = time.time()
+
+
+def submit(zipcode: PositiveInt, description: str, filename: str, report_url: str) -> int:
+    """Queues a crowd cast on the worker pool, refusing new casts once the backlog is full."""
+    with lock:
+        if pending() >= constants.cast_backlog:
+            logger.warning("Crowd cast backlog is full, rejecting cast for %s", zipcode)
+            raise HTTPException(status_code=429, detail="too many crowd casts in progress, please try again later")
+        job_id = max(jobs, default=0) + 1
+        jobs[job_id] = {"zipcode": zipcode, "status": "queued", "submitted": time.time()}
+        finished = [key for key, job in jobs.items() if job["status"] in ("done", "failed")]
+        for key in finished[:max(len(finished) - constants.cast_history, 0)]:
+            del jobs[key]
+    executor.submit(run, job_id, zipcode, description, filename, report_url)
+    return job_id
+
+
+def status() -> dict:
+    with lock:
+        snapshot = {job_id: dict(job) for job_id, job in jobs.items()}
+    counts = {state: 0 for state in ("queued", "running", "done", "failed")}
+    for job in snapshot.values():
+        counts[job["status"]] += 1
+    return {"workers": env.cast_workers, "backlog": constants.cast_backlog, "counts": counts, "jobs": snapshot}
@@ -1,31 +1,173 @@
+import math
+import threading
+import time
+from collections import defaultdict
+
 from fastapi import HTTPException
-from geopy.distance import geodesic
-from geopy.exc import GeopyError
+from geopy.exc import GeocoderRateLimited, GeopyError
 from geopy.geocoders import Nominatim
 from pydantic import PositiveInt
 
+from helpers import metrics
+from helpers.throttle import SingleFlight, TokenBucket
 from helpers.log import logger
+from modules import database
+from modules.accessories import constants, env
+
+geolocator = Nominatim(domain=env.geocoder_domain, scheme="http", user_agent="test/1")
+coordinates = {}
+geocoder_limiter = TokenBucket(rate=env.geocoder_rate, capacity=env.geocoder_rate)
+geocoder_flight = SingleFlight("geocoder")
+
+EARTH_RADIUS = 3958.8  # miles
+MILES_PER_DEGREE = 69.0
 
 
 def get_coordinates(zipcode: PositiveInt):
-    geolocator = Nominatim(scheme="http", user_agent="test/1")
-    location = geolocator.geocode(str(zipcode), country_codes="us")
+    if not coordinates:
+        coordinates.update(database.get_coordinates())
+        logger.info("Loaded %d zipcode coordinates from the DB", len(coordinates))
+    if location := coordinates.get(zipcode):
+        metrics.inc("cache_requests_total", cache="coordinates", result="hit")
+        return location
+    metrics.inc("cache_requests_total", cache="coordinates", result="miss")
+    return geocoder_flight.do(zipcode, geocode, zipcode)
+
+
+def geocode(zipcode: PositiveInt):
+    """Looks up a zipcode upstream within the geocoder's rate limit and stores the result."""
+    if location := coordinates.get(zipcode):
+        return location
+    if location := database.find_coordinates(zipcode):
+        # geocoded by another worker since this one loaded the coordinates
+        coordinates[zipcode] = location
+        return location
+    geocoder_limiter.acquire()
+    try:
+        with metrics.timer("upstream_seconds", upstream="geocoder"):
+            location = geolocator.geocode(str(zipcode), country_codes="us")
+    except GeocoderRateLimited as error:
+        metrics.inc("upstream_errors_total", upstream="geocoder")
+        metrics.inc("upstream_throttled_total", upstream="geocoder")
+        geocoder_limiter.backoff(error.retry_after)
+        raise
+    except GeopyError:
+        metrics.inc("upstream_errors_total", upstream="geocoder")
+        raise
+    geocoder_limiter.recover()
     if location:
+        coordinates[zipcode] = location.latitude, location.longitude
+        database.put_coordinates(zipcode, location.latitude, location.longitude)
         return location.latitude, location.longitude
     raise HTTPException(status_code=400, detail='zipcode invalid or not in the US')
 
 
-def find_distance(zipcode1: PositiveInt, zipcode2: PositiveInt):
-    logger.info("zipcode1: %d", zipcode1)
-    logger.info("zipcode2: %d", zipcode2)
-    if zipcode1 == zipcode2:
-        return 0
-    try:
-        location1 = get_coordinates(zipcode1)
-        location2 = get_coordinates(zipcode2)
-    except GeopyError as error:
-        logger.error(error)
-        return 0
-    logger.info("coordinates1: %s", location1)
-    logger.info("coordinates2: %s", location2)
-    return geodesic(location1, location2).miles
+def haversine(location1: tuple, location2: tuple) -> float:
+    """Great-circle distance in miles, close enough to geodesic for the casting radius."""
+    lat1, lon1, lat2, lon2 = map(math.radians, (*location1, *location2))
+    arc = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(arc))
+
+
+class ZipIndex:
+    """Grid bucketed index over subscribed zipcodes to answer radius queries without scanning every subscriber.
+
+    Request threads add and remove zipcodes while crowd casts query it, so every change and read of the grid
+    happens under a lock, and geocoding always happens outside of it. Subscriptions made through other workers
+    only reach the index through ``refresh``.
+    """
+
+    def __init__(self, cell_size: float = 0.5):
+        self.cell_size = cell_size
+        self.cells = defaultdict(set)
+        self.locations = {}
+        self.loaded = False
+        self.refreshed = 0.0
+        self.lock = threading.Lock()
+        self.load_lock = threading.Lock()
+
+    def cell(self, location: tuple) -> tuple:
+        return int(location[0] // self.cell_size), int(location[1] // self.cell_size)
+
+    def refresh(self):
+        """Syncs the index with the zipcodes subscribed through every worker, at most every ``index_refresh`` seconds.
+
+        Only zipcodes new to the index are located. The first call builds it and marks it loaded once complete,
+        later calls return right away while another thread is refreshing, as the current index will do meanwhile.
+        """
+        if not self.load_lock.acquire(blocking=not self.loaded):
+            return
+        try:
+            if self.loaded and time.time() - self.refreshed < constants.index_refresh:
+                return
+            with self.lock:
+                # taken before reading the DB, so a zipcode added here in the meantime is never dropped
+                indexed = set(self.locations)
+            subscribed = set(database.get_zipcodes())
+            located = {}
+            for zipcode in subscribed - indexed:
+                if location := self.locate(zipcode):
+                    located[zipcode] = location
+            with self.lock:
+                for zipcode in indexed - subscribed:
+                    self.discard(zipcode)
+                for zipcode, location in located.items():
+                    self.insert(zipcode, location)
+                self.loaded = True
+            self.refreshed = time.time()
+            logger.info("Indexed %d subscribed zipcodes (%d added, %d removed)",
+                        len(self.locations), len(located), len(indexed - subscribed))
+        finally:
+            self.load_lock.release()
+
+    def locate(self, zipcode: PositiveInt):
+        try:
+            return get_coordinates(zipcode)
+        except (GeopyError, HTTPException) as error:
+            logger.error("Unable to index %s: %s", zipcode, error)
+
+    def insert(self, zipcode: PositiveInt, location: tuple):
+        if zipcode not in self.locations:
+            self.locations[zipcode] = location
+            self.cells[self.cell(location)].add(zipcode)
+
+    def add(self, zipcode: PositiveInt):
+        if zipcode in self.locations:
+            return
+        if location := self.locate(zipcode):
+            with self.lock:
+                self.insert(zipcode, location)
+
+    def discard(self, zipcode: PositiveInt):
+        if location := self.locations.pop(zipcode, None):
+            self.cells[self.cell(location)].discard(zipcode)
+
+    def remove(self, zipcode: PositiveInt):
+        with self.lock:
+            self.discard(zipcode)
+
+    def within(self, zipcode: PositiveInt, miles: float) -> set:
+        """Returns all the indexed zipcodes within the given radius of a zipcode."""
+        self.refresh()
+        try:
+            origin = get_coordinates(zipcode)
+        except (GeopyError, HTTPException) as error:
+            logger.error(error)
+            return {zipcode}
+        lat_span = miles / MILES_PER_DEGREE
+        lon_span = miles / (MILES_PER_DEGREE * max(math.cos(math.radians(origin[0])), 0.01))
+        lat_low, lon_low = self.cell((origin[0] - lat_span, origin[1] - lon_span))
+        lat_high, lon_high = self.cell((origin[0] + lat_span, origin[1] + lon_span))
+        with self.lock:
+            candidates = [(candidate, self.locations[candidate])
+                          for lat_cell in range(lat_low, lat_high + 1)
+                          for lon_cell in range(lon_low, lon_high + 1)
+                          for candidate in self.cells.get((lat_cell, lon_cell), ())]
+        nearby = {zipcode}
+        for candidate, location in candidates:
+            if haversine(origin, location) <= miles:
+                nearby.add(candidate)
+        return nearby
+
+
+zip_index = ZipIndex()
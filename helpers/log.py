@@ -1,18 +1,84 @@
+import atexit
+import json
 import logging
+import multiprocessing
 import os
-from datetime import datetime
+import time
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
+
+from modules.accessories import env
 
 if not os.path.isdir("logs"):
     os.mkdir("logs")
 
 DEFAULT_LOG_FORM = '%(asctime)s - %(levelname)s - [%(module)s:%(lineno)d] - %(funcName)s - %(message)s'
 
-handler = logging.FileHandler(filename=datetime.now().strftime(os.path.join('logs', 'weather_%d-%m-%Y.log')))
-handler.setFormatter(logging.Formatter(fmt=DEFAULT_LOG_FORM))
+
+class JSONFormatter(logging.Formatter):
+    """Formats each record as a single line JSON object."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {"time": self.formatTime(record), "level": record.levelname, "module": record.module,
+                   "line": record.lineno, "function": record.funcName, "process": record.process,
+                   "message": record.getMessage()}
+        if record.exc_text:
+            payload["exception"] = record.exc_text
+        return json.dumps(payload)
+
+
+class ModuleLevelFilter(logging.Filter):
+    """Applies per-module levels, configured as ``module=LEVEL`` pairs in LOG_LEVELS."""
+
+    def __init__(self, default: int, levels: dict):
+        super().__init__()
+        self.default = default
+        self.levels = levels
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno >= self.levels.get(record.module, self.default)
+
+
+default_level = logging.getLevelName(env.log_level.upper())
+module_levels = {module.strip(): logging.getLevelName(level.strip().upper())
+                 for module, level in (pair.split("=") for pair in env.log_levels.split(",") if "=" in pair)}
+
+# Every uvicorn worker imports this module, each rotating the file it owns, since rotating a shared file from
+# several processes renames it under the others. The scheduler forked from a worker logs to that worker's file.
+for name in os.listdir("logs"):
+    # files of workers that are gone are never rotated again, so they are dropped once past the retention
+    path = os.path.join("logs", name)
+    try:
+        if name.startswith("weather.") and os.path.getmtime(path) < time.time() - (env.log_retention + 1) * 86_400:
+            os.remove(path)
+    except FileNotFoundError:
+        # removed by a worker starting alongside this one
+        pass
+
+handler = TimedRotatingFileHandler(filename=os.path.join('logs', f'weather.{os.getpid()}.log'), when="midnight",
+                                   backupCount=env.log_retention)
+handler.setFormatter(JSONFormatter() if env.log_json else logging.Formatter(fmt=DEFAULT_LOG_FORM))
+
+# Records are handed to a listener thread through a multiprocessing queue, so request threads never wait on disk
+# and processes forked from this one (background scheduler) log through the same rotating file handler.
+log_queue = multiprocessing.Queue(-1)
+listener = QueueListener(log_queue, handler)
+listener.start()
+
+
+def stop_listener(pid: int = os.getpid()):
+    # forked children inherit the atexit hook, but must not send the stop sentinel to the parent's listener
+    if os.getpid() == pid:
+        listener.stop()
+
+
+atexit.register(stop_listener)
+
+queue_handler = QueueHandler(log_queue)
+queue_handler.addFilter(ModuleLevelFilter(default_level, module_levels))
 
 # Logger levels: DEBUG, INFO, WARNING, ERROR, CRITICAL(FATAL)
 logger = logging.getLogger(__name__)
-logger.addHandler(hdlr=handler)
-logger.setLevel(level=logging.DEBUG)
+logger.addHandler(hdlr=queue_handler)
+logger.setLevel(level=min([default_level, *module_levels.values()]))
 
 logger.info("Hello World")
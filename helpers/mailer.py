@@ -0,0 +1,187 @@
+import os
+import smtplib
+import socket
+import threading
+import time
+from email.mime.application import MIMEApplication
+from functools import lru_cache
+
+import gmailconnector
+from gmailconnector import Response
+
+from helpers import metrics
+from helpers.throttle import TokenBucket
+from helpers.log import logger
+from modules import database
+from modules.accessories import env, constants
+
+
+@lru_cache(maxsize=32)
+def encode_attachment(path: str, modified: float) -> MIMEApplication:
+    """Encodes an attachment once, so a fan-out to many recipients reuses the same MIME part."""
+    with open(path, "rb") as file:
+        attribute = MIMEApplication(file.read(), _subtype=path.split(".")[-1])
+    attribute.add_header("Content-Disposition", "attachment", filename=path.split("/")[-1])
+    return attribute
+
+
+class Mailer(gmailconnector.SendEmail):
+    """SendEmail that keeps its session open, talks to a configurable SMTP host and reuses encoded attachments."""
+
+    def create_connection(self) -> None:
+        try:
+            self.server = smtplib.SMTP(host=env.smtp_host, port=env.smtp_port, timeout=self.env.timeout)
+            if env.smtp_starttls:
+                self.server.starttls()
+        except (smtplib.SMTPException, socket.error) as error:
+            self.error = error.__str__()
+
+    @property
+    def authenticate(self) -> Response:
+        if self.server is not None:
+            try:
+                self.server.ehlo_or_helo_if_needed()
+            except smtplib.SMTPException as error:
+                return Response(dictionary={"ok": False, "status": 503, "body": error.__str__()})
+            if not self.server.has_extn("auth"):
+                # local SMTP stand-ins do not advertise AUTH
+                self._authenticated = True
+                return Response(dictionary={"ok": True, "status": 200, "body": "authentication not required"})
+        return super().authenticate
+
+    def multipart_message(self, subject, recipient, sender, body, html_body, attachments, filenames, cc):
+        self._failed_attachments = {"FILE NOT FOUND": [], "FILE SIZE OVER 25 MB": []}
+        msg = super().multipart_message(subject=subject, recipient=recipient, sender=sender, body=body,
+                                        html_body=html_body, attachments=[], filenames=[], cc=cc)
+        for attachment in attachments:
+            try:
+                msg.attach(payload=encode_attachment(attachment, os.path.getmtime(attachment)))
+            except OSError:
+                self._failed_attachments["FILE NOT FOUND"].append(attachment)
+        return msg
+
+
+wakeup = threading.Event()
+limiter = TokenBucket(rate=env.email_rate, capacity=env.email_rate)
+
+
+def enqueue(recipient: str, subject: str, body: str, attachment: str = None):
+    """Queues a single email and returns immediately."""
+    enqueue_many([(recipient, subject, body, attachment)])
+
+
+def enqueue_many(messages: list):
+    """Queues (recipient, subject, body, attachment) tuples and returns immediately."""
+    if not messages:
+        return
+    database.put_emails(messages)
+    wakeup.set()
+    logger.info("%d email(s) queued", len(messages))
+
+
+def enqueue_iter(messages) -> int:
+    """Queues messages from an iterable a page at a time, so large fan-outs never sit in memory at once."""
+    page, queued = [], 0
+    for message in messages:
+        page.append(message)
+        if len(page) >= constants.page_size:
+            enqueue_many(page)
+            queued, page = queued + len(page), []
+    enqueue_many(page)
+    return queued + len(page)
+
+
+def deliver(client: Mailer, message: tuple) -> Response:
+    email_id, recipient, subject, body, attachment, attempts = message
+    try:
+        if attachment:
+            return client.send_email(recipient=recipient, subject=subject, sender="WeatherTogether",
+                                     body=body, attachment=attachment)
+        return client.send_email(recipient=recipient, subject=subject, sender="WeatherTogether", body=body)
+    except smtplib.SMTPServerDisconnected as error:
+        return Response(dictionary={"ok": False, "status": 421, "body": error.__str__()})
+    except (smtplib.SMTPException, socket.error) as error:
+        return Response(dictionary={"ok": False, "status": 503, "body": error.__str__()})
+
+
+def send(client: Mailer, message: tuple):
+    """Sends a claimed email and records the outcome, returning the client to reuse for the next one."""
+    email_id, recipient = message[0], message[1]
+    reused = client is not None
+    if not reused:
+        client = Mailer(gmail_user=env.email_username, gmail_pass=env.email_password)
+    limiter.acquire()
+    with metrics.timer("send_email_seconds"):
+        response = deliver(client, message)
+        if reused and response.status == 421:
+            # servers close sessions that sit idle, so reconnect and resend right away instead of spending an attempt
+            logger.info("SMTP session was closed by the server, reconnecting")
+            client = Mailer(gmail_user=env.email_username, gmail_pass=env.email_password)
+            response = deliver(client, message)
+    metrics.inc("emails_total", status="sent" if response.ok else "failed")
+    if response.ok:
+        database.update_email(email_id, "sent")
+        logger.info("Email %d has been sent to %s", email_id, recipient)
+        return client
+    fail(message, response.status, response.body)
+    # drop the session unless the message itself was at fault, it is re-created on the next message
+    return client if response.status == 422 else None
+
+
+def fail(message: tuple, status: int, error: str):
+    email_id, recipient, attempts = message[0], message[1], message[5] + 1
+    if attempts >= constants.email_attempts or status == 422:
+        database.update_email(email_id, "dead", attempts, error=error)
+        metrics.inc("emails_total", status="dead")
+        logger.error("Email %d to %s moved to dead letter: %s", email_id, recipient, error)
+    else:
+        database.update_email(email_id, "queued", attempts, time.time() + 30 * 2 ** attempts, error)
+        logger.warning("Email %d to %s failed, attempt %d: %s", email_id, recipient, attempts, error)
+
+
+def worker():
+    """Sends queued emails over a persistent session, retrying with backoff and dead-lettering after max attempts."""
+    client = None
+    while True:
+        try:
+            message = database.claim_email(time.time())
+        except Exception as error:
+            logger.exception(error)
+            time.sleep(constants.email_poll)
+            continue
+        if not message:
+            wakeup.wait(timeout=constants.email_poll)
+            wakeup.clear()
+            continue
+        try:
+            client = send(client, message)
+        except Exception as error:
+            # anything unexpected (address validation, a locked database) must not end the worker
+            logger.exception(error)
+            client = None
+            metrics.inc("emails_total", status="failed")
+            try:
+                # a malformed message (ValueError, e.g. an invalid address) will never go through, so don't retry it
+                fail(message, 422 if isinstance(error, ValueError) else 500, error.__str__() or type(error).__name__)
+            except Exception as update_error:
+                # the row stays in sending and is requeued once it is stale
+                logger.exception(update_error)
+
+
+def reclaim():
+    """Periodically requeues emails stuck in sending by a worker or process that died mid-send."""
+    while True:
+        try:
+            if count := database.reset_emails(time.time() - constants.email_stale):
+                logger.warning("Requeued %d stale email(s)", count)
+                wakeup.set()
+        except Exception as error:
+            logger.exception(error)
+        time.sleep(constants.email_stale / 2)
+
+
+def start():
+    threading.Thread(target=reclaim, name="mailer-reclaim", daemon=True).start()
+    for index in range(env.email_workers):
+        threading.Thread(target=worker, name=f"mailer-{index}", daemon=True).start()
+    logger.info("Started %d mailer workers", env.email_workers)
@@ -0,0 +1,183 @@
+import functools
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from modules import database
+from modules.accessories import constants
+
+PREFIX = "weathertogether_"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (0, 1, 5, 10, 50, 100, 500, 1_000, 5_000, 10_000)
+
+lock = threading.Lock()
+counters, gauges, histograms = {}, {}, {}
+
+
+def key(name: str, labels: dict) -> tuple:
+    return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+
+def inc(name: str, value: float = 1, **labels):
+    with lock:
+        counters[key(name, labels)] = counters.get(key(name, labels), 0) + value
+
+
+def set_gauge(name: str, value: float, **labels):
+    with lock:
+        gauges[key(name, labels)] = value
+
+
+def observe(name: str, value: float, buckets: tuple = LATENCY_BUCKETS, **labels):
+    with lock:
+        histogram = histograms.get(key(name, labels))
+        if histogram is None:
+            histogram = histograms[key(name, labels)] = {"buckets": buckets, "counts": [0] * len(buckets),
+                                                         "sum": 0.0, "count": 0}
+        index = bisect_left(histogram["buckets"], value)
+        if index < len(histogram["counts"]):
+            histogram["counts"][index] += 1
+        histogram["sum"] += value
+        histogram["count"] += 1
+
+
+@contextmanager
+def timer(name: str, **labels):
+    """Observes the wall time of the block in seconds."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def timed(name: str, **labels):
+    """Decorator form of ``timer`` that labels the observation with the function name."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with timer(name, function=function.__name__, **labels):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+database.observe = observe
+
+
+def reset():
+    """Forgets everything recorded so far, for a forked process that would otherwise report its parent's metrics."""
+    global lock
+    # the parent may have been holding the lock in another thread at the time of the fork
+    lock = threading.Lock()
+    counters.clear()
+    gauges.clear()
+    histograms.clear()
+
+
+def snapshot() -> dict:
+    with lock:
+        return {
+            "counters": [[name, labels, value] for (name, labels), value in counters.items()],
+            "gauges": [[name, labels, value] for (name, labels), value in gauges.items()],
+            "histograms": [[name, labels, dict(histogram, counts=list(histogram["counts"]))]
+                           for (name, labels), histogram in histograms.items()],
+        }
+
+
+def flush():
+    """Writes this process's metrics where the web process can merge them."""
+    temp_file = os.path.join(constants.metrics_dir, f"{os.getpid()}.json.tmp")
+    with open(temp_file, "w") as file:
+        json.dump(snapshot(), file)
+    os.replace(temp_file, os.path.join(constants.metrics_dir, f"{os.getpid()}.json"))
+
+
+def flusher():
+    while True:
+        time.sleep(constants.metrics_flush)
+        flush()
+
+
+def start():
+    """Starts periodically flushing the metrics of the current process."""
+    if not os.path.isdir(constants.metrics_dir):
+        os.makedirs(constants.metrics_dir, exist_ok=True)
+    threading.Thread(target=flusher, name="metrics", daemon=True).start()
+
+
+def alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def collect() -> list:
+    """Snapshots of this process and every other live process that flushed its metrics."""
+    snapshots = [snapshot()]
+    if not os.path.isdir(constants.metrics_dir):
+        return snapshots
+    for file_name in os.listdir(constants.metrics_dir):
+        pid = file_name.split(".")[0]
+        if not file_name.endswith(".json") or not pid.isdigit() or int(pid) == os.getpid():
+            continue
+        if not alive(int(pid)):
+            os.remove(os.path.join(constants.metrics_dir, file_name))
+            continue
+        try:
+            with open(os.path.join(constants.metrics_dir, file_name)) as file:
+                snapshots.append(json.load(file))
+        except (OSError, ValueError):
+            continue
+    return snapshots
+
+
+def format_labels(labels, extra: tuple = ()) -> str:
+    pairs = [*map(tuple, labels), *extra]
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{label}="{value}"' for (label, _), value in zip(pairs, escaped)) + "}"
+
+
+def render() -> str:
+    """Merges the metrics of every process in the Prometheus text exposition format."""
+    merged_counters, merged_gauges, merged_histograms = {}, {}, {}
+    for each in collect():
+        for name, labels, value in each["counters"]:
+            merged_counters[key(name, dict(labels))] = merged_counters.get(key(name, dict(labels)), 0) + value
+        for name, labels, value in each["gauges"]:
+            merged_gauges[key(name, dict(labels))] = value
+        for name, labels, histogram in each["histograms"]:
+            merged = merged_histograms.setdefault(key(name, dict(labels)), {
+                "buckets": histogram["buckets"], "counts": [0] * len(histogram["buckets"]), "sum": 0.0, "count": 0
+            })
+            merged["counts"] = [total + count for total, count in zip(merged["counts"], histogram["counts"])]
+            merged["sum"] += histogram["sum"]
+            merged["count"] += histogram["count"]
+    lines, typed = [], set()
+    for kind, merged in (("counter", merged_counters), ("gauge", merged_gauges)):
+        for (name, labels), value in sorted(merged.items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {PREFIX}{name} {kind}")
+            lines.append(f"{PREFIX}{name}{format_labels(labels)} {value}")
+    for (name, labels), histogram in sorted(merged_histograms.items()):
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {PREFIX}{name} histogram")
+        cumulative = 0
+        for bucket, count in zip(histogram["buckets"], histogram["counts"]):
+            cumulative += count
+            lines.append(f"{PREFIX}{name}_bucket{format_labels(labels, (('le', bucket),))} {cumulative}")
+        lines.append(f"{PREFIX}{name}_bucket{format_labels(labels, (('le', '+Inf'),))} {histogram['count']}")
+        lines.append(f"{PREFIX}{name}_sum{format_labels(labels)} {histogram['sum']}")
+        lines.append(f"{PREFIX}{name}_count{format_labels(labels)} {histogram['count']}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,130 @@
+import asyncio
+import concurrent.futures
+import json
+import threading
+from collections import defaultdict
+
+from fastapi import HTTPException, Request
+
+from helpers import metrics, sessions, validators
+from modules import database
+from modules.accessories import constants
+
+
+class Subscription:
+    """One dashboard connection, listening for crowd casts that reach any of its zipcodes."""
+
+    def __init__(self, userid: int, zipcodes: set):
+        self.userid = userid
+        self.zipcodes = zipcodes
+        self.queue = asyncio.Queue(maxsize=constants.push_backlog)
+
+    def offer(self, event: dict) -> bool:
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            metrics.inc("push_events_total", result="dropped")
+            return False
+        return True
+
+
+class Broker:
+    """In-process fan-out of crowd casts to the dashboards connected to this worker, indexed by zipcode.
+
+    Connections live on the event loop, while casts are published from the casting pool, so events are handed
+    over with ``run_coroutine_threadsafe`` and the index itself is guarded by a lock.
+    """
+
+    def __init__(self):
+        self.loop = None
+        self.subscriptions = defaultdict(set)
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def subscribe(self, userid: int, zipcodes: set) -> Subscription:
+        self.loop = asyncio.get_running_loop()
+        subscription = Subscription(userid, zipcodes)
+        with self.lock:
+            for zipcode in zipcodes:
+                self.subscriptions[zipcode].add(subscription)
+            self.count += 1
+            metrics.set_gauge("push_connections", self.count)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self.lock:
+            for zipcode in subscription.zipcodes:
+                self.subscriptions[zipcode].discard(subscription)
+                if not self.subscriptions[zipcode]:
+                    del self.subscriptions[zipcode]
+            self.count -= 1
+            metrics.set_gauge("push_connections", self.count)
+
+    def listeners(self, zipcodes: set) -> set:
+        """Userids with a connection listening to any of the zipcodes."""
+        with self.lock:
+            return {subscription.userid for zipcode in zipcodes for subscription in self.subscriptions.get(zipcode, ())}
+
+    @staticmethod
+    async def deliver(targets: set, event: dict) -> set:
+        return {subscription.userid for subscription in targets if subscription.offer(event)}
+
+    def publish(self, zipcodes: set, event: dict, recipients: set) -> set:
+        """Pushes an event to the recipients' connections listening to any of the zipcodes and returns those reached.
+
+        Must be called from outside the event loop, since it waits for the events to be queued on it. Connections
+        that are too far behind to take the event are left out, and so is everyone if the loop does not get to it
+        within ``push_confirm`` seconds, so those users get the email instead.
+        """
+        if self.loop is None or self.loop.is_closed():
+            return set()
+        with self.lock:
+            targets = {subscription for zipcode in zipcodes for subscription in self.subscriptions.get(zipcode, ())
+                       if subscription.userid in recipients}
+        if not targets:
+            return set()
+        future = asyncio.run_coroutine_threadsafe(self.deliver(targets, event), self.loop)
+        try:
+            reached = future.result(timeout=constants.push_confirm)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            metrics.inc("push_events_total", len(targets), result="timeout")
+            return set()
+        metrics.inc("push_events_total", len(reached), result="sent")
+        return reached
+
+
+broker = Broker()
+
+
+def authorize(request: Request, zipcodes: list) -> tuple:
+    """Returns the userid and zipcodes to listen to, defaulting to the signed in user's subscribed zipcodes."""
+    if not (session := sessions.from_request(request)):
+        raise HTTPException(status_code=401, detail="sign in to receive crowd casts")
+    if broker.count >= constants.push_connections:
+        raise HTTPException(status_code=503, detail="too many live connections, crowd casts will arrive by email")
+    if zipcodes and len(zipcodes) > constants.push_zipcodes:
+        raise HTTPException(status_code=400, detail=f"listen to at most {constants.push_zipcodes} zipcodes")
+    if invalid := [zipcode for zipcode in zipcodes or () if not validators.validate_zip(zipcode)]:
+        raise HTTPException(status_code=400, detail=f"zipcodes are invalid: {invalid}. zipcodes must be 5-digit")
+    return session[0], set(zipcodes or (each[3] for each in database.get_subscriptions(session[1])))
+
+
+async def events(userid: int, zipcodes: set):
+    """Server-Sent Events for a connection, with a comment line every ``push_keepalive`` seconds when idle.
+
+    The subscription is made once the response starts streaming, so it always ends with the response.
+    """
+    subscription = broker.subscribe(userid, zipcodes)
+    try:
+        yield "retry: 5000\n\n"
+        while True:
+            try:
+                event = await asyncio.wait_for(subscription.queue.get(), timeout=constants.push_keepalive)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            payload = dict(event, report_url=f"{event['report_url']}{subscription.userid}")
+            yield f"event: crowd-cast\ndata: {json.dumps(payload)}\n\n"
+    finally:
+        broker.unsubscribe(subscription)
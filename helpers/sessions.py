@@ -0,0 +1,136 @@
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from fastapi import Request
+
+from helpers import metrics
+from modules import database
+from modules.accessories import constants, env
+
+COOKIE = "session"
+SECRET_BYTES = 32
+
+
+def read_secret():
+    """Returns the key on disk, waiting briefly in case another worker is still putting it in place."""
+    for _ in range(constants.session_secret_reads):
+        try:
+            with open(constants.session_secret_file, "rb") as file:
+                secret = file.read().strip()
+        except FileNotFoundError:
+            return
+        if len(secret) >= SECRET_BYTES:
+            return secret
+        time.sleep(0.1)
+    raise RuntimeError(f"{constants.session_secret_file} holds a key shorter than {SECRET_BYTES} bytes, "
+                       "delete it to have a new one generated")
+
+
+def load_secret() -> bytes:
+    """The signing key from SESSION_SECRET, or one generated once and kept on disk for every worker to share."""
+    if env.session_secret:
+        if len(env.session_secret) < SECRET_BYTES:
+            raise ValueError(f"SESSION_SECRET must be at least {SECRET_BYTES} characters long")
+        return env.session_secret.encode()
+    if secret := read_secret():
+        return secret
+    # written in full to a file of its own and then linked into place, so no worker ever reads a partial key
+    secret = secrets.token_hex(SECRET_BYTES).encode()
+    temp_file = f"{constants.session_secret_file}.{os.getpid()}.tmp"
+    descriptor = os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(descriptor, "wb") as file:
+        file.write(secret)
+        file.flush()
+        os.fsync(file.fileno())
+    try:
+        os.link(temp_file, constants.session_secret_file)
+    except FileExistsError:
+        # another worker won the race, use its key
+        secret = read_secret()
+    finally:
+        os.remove(temp_file)
+    return secret
+
+
+secret = load_secret()
+
+
+def sign(payload: str) -> str:
+    return base64.urlsafe_b64encode(hmac.new(secret, payload.encode(), hashlib.sha256).digest()).decode().rstrip("=")
+
+
+def issue(userid: int, email_address: str) -> str:
+    """Returns a token of the form ``userid.email.expires.signature`` valid for ``constants.session_ttl`` seconds."""
+    email = base64.urlsafe_b64encode(email_address.encode()).decode().rstrip("=")
+    payload = f"{userid}.{email}.{int(time.time()) + constants.session_ttl}"
+    return f"{payload}.{sign(payload)}"
+
+
+def verify(token: str):
+    """Returns the userid and email address of a token with a valid signature that has not expired."""
+    try:
+        userid, email, expires, signature = token.split(".")
+    except (AttributeError, ValueError):
+        return
+    if not secrets.compare_digest(signature, sign(f"{userid}.{email}.{expires}")):
+        metrics.inc("sessions_total", result="invalid")
+        return
+    if not expires.isdigit() or int(expires) < time.time():
+        metrics.inc("sessions_total", result="expired")
+        return
+    return int(userid), base64.urlsafe_b64decode(email + "=" * (-len(email) % 4)).decode()
+
+
+class ActiveUsers:
+    """Small LRU of userids recently confirmed to still be subscribed, rechecked after ``ttl`` seconds."""
+
+    def __init__(self, max_size: int, ttl: int):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def check(self, userid: int, email_address: str) -> bool:
+        with self.lock:
+            checked = self.entries.get((userid, email_address))
+            if checked and time.time() - checked < self.ttl:
+                self.entries.move_to_end((userid, email_address))
+                metrics.inc("cache_requests_total", cache="sessions", result="hit")
+                return True
+        metrics.inc("cache_requests_total", cache="sessions", result="miss")
+        retrieve = database.get_user(email_address)
+        if not retrieve or retrieve[0] != userid:
+            self.forget(userid, email_address)
+            return False
+        with self.lock:
+            self.entries[(userid, email_address)] = time.time()
+            self.entries.move_to_end((userid, email_address))
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return True
+
+    def forget(self, userid: int, email_address: str):
+        with self.lock:
+            self.entries.pop((userid, email_address), None)
+
+
+active_users = ActiveUsers(max_size=constants.session_cache_size, ttl=constants.blocked_refresh)
+
+
+def from_request(request: Request):
+    """Returns the userid and email address of the session sent as a bearer token or cookie, if it is still valid."""
+    authorization = request.headers.get("authorization", "")
+    token = authorization[7:] if authorization.lower().startswith("bearer ") else request.cookies.get(COOKIE)
+    if not token or not (claims := verify(token)):
+        return
+    if not active_users.check(*claims):
+        metrics.inc("sessions_total", result="unsubscribed")
+        return
+    metrics.inc("sessions_total", result="valid")
+    return claims
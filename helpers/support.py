@@ -1,29 +1,23 @@
-import json
-import os
 import random
 import secrets
 import string
 import time
 from datetime import datetime
-from threading import Timer
 
-import gmailconnector
 from fastapi import HTTPException
 from pydantic import EmailStr, PositiveInt
 
-from helpers import validators, log, tokenizer
-from helpers.location import find_distance
-from modules.accessories import user_data, otp_dict, constants, env
-from modules.database import get_existing_info, db
+from helpers import validators, log, tokenizer, mailer, metrics, push
+from helpers.location import zip_index
+from modules import database
+from modules.accessories import constants, env, schedule_queue
 
 logger = log.logger
-
-email_object = gmailconnector.SendEmail(gmail_user=env.email_username,
-                                        gmail_pass=env.email_password)
+blocked_cache = {"userids": set(), "loaded": 0}
 
 
 def validations(email_address: EmailStr, password: str, zipcode: PositiveInt, report_time: str,
-                frequency: int, otp: str, accept_crowd_sourcing: bool):
+                frequency: int, otp: str, accept_crowd_sourcing: bool, session: tuple = None):
     """This function validates all the input parameters."""
     zip_valid = validators.validate_zip(zipcode)
     if not zip_valid:
@@ -42,34 +36,28 @@ def validations(email_address: EmailStr, password: str, zipcode: PositiveInt, re
     result = validators.validate_email_address(email_address)
     if result:
         raise HTTPException(status_code=400, detail="email is invalid: %s. %s" % (email_address, result))
-    with db.connection:
-        cursor = db.connection.cursor()
-        retrieve = cursor.execute(
-            "SELECT * FROM container WHERE email_address=?;", (email_address,)
-        ).fetchall()
+    retrieve = database.get_subscriptions(email_address)
+    stored_password = None
     if retrieve:
-        userid = retrieve[0][1]
+        userid = retrieve[0][0]
         if userid in get_blocked():
             raise HTTPException(status_code=403, detail='user blocked')
-        pwd = tokenizer.hex_decode(retrieve[0][2])
-        if not secrets.compare_digest(pwd, password):
+        if session == (userid, email_address):
+            # the session already proved the password, new subscriptions keep the stored one
+            stored_password = retrieve[0][2]
+        elif not secrets.compare_digest(tokenizer.hex_decode(retrieve[0][2]), password):
             raise HTTPException(status_code=401, detail='unauthorized')
         for each in retrieve:
             if zipcode == each[3] and report_time == each[4]:
                 # todo: check if api is requesting pw again
                 raise HTTPException(status_code=409, detail='entry for this zipcode already exists in DB')
             if zipcode == each[3] and (report_time != each[4] or frequency != each[5]):
-                with db.connection:
-                    cursor = db.connection.cursor()
-                    cursor.execute(
-                        "UPDATE container SET report_time=?, frequency=? WHERE email_address=? AND zipcode=?;",
-                        (report_time, frequency, email_address, zipcode)
-                    )
-                    db.connection.commit()
+                database.update_schedule(email_address, zipcode, report_time, frequency)
+                schedule_queue.put((report_time, frequency))
     else:
-        userid = int(time.time())
+        userid = database.next_userid(time.time())
     if otp:
-        if otp == otp_dict.get(email_address):
+        if database.check_otp(email_address, otp, time.time(), constants.otp_attempts):
             logger.info("%s passed OTP validation", email_address)
         else:
             raise HTTPException(status_code=401, detail="unauthorized or timed out")
@@ -79,97 +67,99 @@ def validations(email_address: EmailStr, password: str, zipcode: PositiveInt, re
             return {"OK": "Please enter the OTP"}
         else:
             raise HTTPException(status_code=500, detail="failed to send otp")
-    password = tokenizer.hex_encode(password)
-    with db.connection:
-        cursor = db.connection.cursor()
-        cursor.execute(
-            f"INSERT or REPLACE INTO container {user_data.user_input} VALUES (?,?,?,?,?,?,?);",
-            (userid, email_address, password, zipcode, report_time, frequency, accept_crowd_sourcing)
-        )
-        db.connection.commit()
-    response = email_object.send_email(recipient=email_address,
-                                       subject=f"Welcome to WeatherTogether {datetime.now().strftime('%c')}",
-                                       sender="WeatherTogether",
-                                       body="Hi,\n\n"
-                                            "Thank you for signing up to WeatherTogether.\n\n"
-                                            "You will now be able to "
-                                            f"receive daily weather information at your requested time: {report_time}, "
-                                            f"and receive severe weather alerts.\n\nYou can also login to the "
-                                            "WeatherTogether dashboard to broadcast weather alerts.")
-    if response.ok:
-        logger.info("Subscription confirmation has been sent to %s", email_address)
+    password = stored_password or tokenizer.hex_encode(password)
+    database.put_subscription(userid, email_address, password, zipcode, report_time, frequency,
+                              accept_crowd_sourcing)
+    zip_index.add(zipcode)
+    schedule_queue.put((report_time, frequency))
+    mailer.enqueue(*welcome_email(email_address, report_time))
+    logger.info("Subscription confirmation has been queued for %s", email_address)
     return {"OK": "Entry is added to the database successfully"}
 
 
-def send_otp(email_address: EmailStr):
-    rand_str = ''.join(random.choices(string.ascii_uppercase + string.digits, k=5))
-    response = email_object.send_email(recipient=email_address,
-                                       subject=f"WeatherTogether - Verify your email {datetime.now().strftime('%c')}",
-                                       sender="WeatherTogether",
-                                       body="Hi,\n\n"
-                                            "We received a signup request for WeatherTogether Application.\n\n"
-                                            "Please enter the code below to sign in: \n\n"
-                                            f"{rand_str}\n\n"
-                                            "The code will expire in 5 minutes.")
-    if response.ok:
-        logger.info("One time verification passcode has been sent to %s", email_address)
-        otp_dict[email_address] = rand_str
-        Timer(function=delete_otp, args=(email_address,), interval=300).start()
-        return True
-    else:
-        logger.error(response.body)
+def welcome_email(email_address: EmailStr, report_time: str) -> tuple:
+    return (email_address, f"Welcome to WeatherTogether {datetime.now().strftime('%c')}",
+            "Hi,\n\n"
+            "Thank you for signing up to WeatherTogether.\n\n"
+            "You will now be able to "
+            f"receive daily weather information at your requested time: {report_time}, "
+            f"and receive severe weather alerts.\n\nYou can also login to the "
+            "WeatherTogether dashboard to broadcast weather alerts.", None)
 
 
-def delete_otp(email_address: EmailStr):
-    # otp_dict.pop(email_address)
-    # del otp_dict[email_address]
-    otp_dict[email_address] = None
+def send_otp(email_address: EmailStr):
+    rand_str = ''.join(random.choices(string.ascii_uppercase + string.digits, k=5))
+    database.put_otp(email_address, rand_str, time.time() + constants.otp_ttl, time.time())
+    mailer.enqueue(recipient=email_address,
+                   subject=f"WeatherTogether - Verify your email {datetime.now().strftime('%c')}",
+                   body="Hi,\n\n"
+                        "We received a signup request for WeatherTogether Application.\n\n"
+                        "Please enter the code below to sign in: \n\n"
+                        f"{rand_str}\n\n"
+                        "The code will expire in 5 minutes.")
+    logger.info("One time verification passcode has been queued for %s", email_address)
+    return True
 
 
-def crowd_cast(zipcode: PositiveInt, description: str, filename: str, report_url: str):
-    db_data = get_existing_info()
-    logger.info("User data gathered from DB")
+def crowd_cast(zipcode: PositiveInt, description: str, filename: str, report_url: str) -> int:
     sender_id = report_url.split("/")[-2]
     logger.info("report sent by userid %s", sender_id)
-    notify_zipcodes = []
-    for each_entry in db_data:
-        user_zip = each_entry[3]
-        if user_zip not in notify_zipcodes:
-            if find_distance(user_zip, zipcode) <= env.casting_distance:
-                notify_zipcodes.append(user_zip)
+    notify_zipcodes = zip_index.within(zipcode, env.casting_distance)
     logger.info("No. of zipcodes to notify: %d", len(notify_zipcodes))
-    notified_users = []
-    for each_entry in db_data:
-        user_zip = each_entry[3]
-        if user_zip in notify_zipcodes:
-            user_id = each_entry[0]
-            if int(user_id) == int(sender_id):
-                continue
-            user_email = each_entry[1]
-            acceptance = each_entry[-1]
-            if not acceptance or user_email in notified_users:
+    # dashboards connected to this worker get the cast right away, email covers everyone else
+    # listeners may follow zipcodes they are not subscribed near, so only their own opt-out applies
+    listeners = push.broker.listeners(notify_zipcodes) - {int(sender_id)}
+    accepting = database.get_crowd_userids(listeners) if listeners else set()
+    online = push.broker.publish(notify_zipcodes, {"zipcode": zipcode, "description": description,
+                                                   "image": bool(filename), "time": datetime.now().isoformat(),
+                                                   "report_url": report_url}, accepting)
+    logger.info("Pushed to %d connected user(s)", len(online))
+    subject = f"Weather Alert {datetime.now().strftime('%c')}"
+
+    def recipients():
+        # rows are ordered by email address, so a repeated address is always the previous one
+        last_email = None
+        for user_id, user_email in database.iter_crowd_subscribers(notify_zipcodes, ("userid", "email_address")):
+            if int(user_id) == int(sender_id) or int(user_id) in online or user_email == last_email:
                 continue
-            # todo: create a thread to send notifications
+            last_email = user_email
             logger.info("Broadcasting to %s", user_email)
-            report_url += str(user_id)
             reformed = "Someone near by casted this weather information\n\n\n" + description + \
                        "\n\n\nIf you think this information is inappropriate, please report using the following link:" \
-                       f"\n{report_url}"
-            if filename:
-                response = email_object.send_email(subject=f"Weather Alert {datetime.now().strftime('%c')}",
-                                                   sender="WeatherTogether", body=reformed,
-                                                   recipient=user_email, attachment=filename)
-            else:
-                response = email_object.send_email(subject=f"Weather Alert {datetime.now().strftime('%c')}",
-                                                   sender="WeatherTogether", body=reformed,
-                                                   recipient=user_email)
-            if response.ok:
-                notified_users.append(user_email)
-            logger.info(response.body)
-
-
-def get_blocked():
-    if os.path.isfile(constants.blocked_file):
-        with open(constants.blocked_file) as file:
-            return json.load(file)
-    return []
+                       f"\n{report_url}{user_id}"
+            yield user_email, subject, reformed, filename or None
+
+    queued = mailer.enqueue_iter(recipients())
+    metrics.observe("crowd_cast_recipients", queued, buckets=metrics.SIZE_BUCKETS)
+    return queued
+
+
+def authenticate(email_address: EmailStr, password: str, session: tuple = None) -> int:
+    """Returns the userid of the email address, authenticated by its session or else by password."""
+    if session and session[1] == email_address:
+        return session[0]
+    retrieve = database.get_user(email_address)
+    if not retrieve:
+        raise HTTPException(status_code=404, detail=f"{email_address} is currently not "
+                                                    "subscribed to WeatherTogether")
+    if not password or not secrets.compare_digest(password, tokenizer.hex_decode(retrieve[1])):
+        raise HTTPException(status_code=401, detail="invalid email address or password")
+    return retrieve[0]
+
+
+def get_blocked() -> set:
+    """Blocked userids, cached in memory and refreshed periodically to pick up blocks from other workers."""
+    if time.time() - blocked_cache["loaded"] > constants.blocked_refresh:
+        blocked_cache["userids"] = database.get_blocked()
+        blocked_cache["loaded"] = time.time()
+    return blocked_cache["userids"]
+
+
+def block_user(block_id: int, user_id: int) -> bool:
+    """Records a spam report and returns True if it pushed the user over the block threshold."""
+    duplicate, blocked = database.put_report(block_id, user_id, constants.report_threshold)
+    if duplicate:
+        logger.warning("duplicate report on %d by %d", block_id, user_id)
+    if blocked:
+        get_blocked().add(block_id)
+    return blocked
@@ -0,0 +1,93 @@
+import threading
+import time
+
+from helpers import metrics
+
+
+class TokenBucket:
+    """Allows ``rate`` acquisitions per second with bursts up to ``capacity``.
+
+    ``backoff`` halves the rate (down to ``min_rate``) and optionally pauses the bucket when an upstream pushes back,
+    ``recover`` then raises it again step by step after each successful call.
+    """
+
+    def __init__(self, rate: float, capacity: float, min_rate: float = None):
+        self.max_rate = rate
+        self.min_rate = min_rate or rate / 16
+        self.rate = rate
+        self.capacity = max(capacity, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                else:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def backoff(self, retry_after=None):
+        try:
+            pause = float(retry_after)
+        except (TypeError, ValueError):
+            pause = 0.0
+        with self.lock:
+            now = time.monotonic()
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = 0
+            self.paused_until = max(self.paused_until, now + pause)
+            self.updated = max(now, self.paused_until)
+
+    def recover(self):
+        if self.rate < self.max_rate:
+            with self.lock:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+
+class Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Lets concurrent callers asking for the same key share a single in-flight call and its result or error."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, function, *args):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Call()
+        if not leader:
+            metrics.inc("upstream_coalesced_total", upstream=self.name)
+            call.done.wait()
+            if call.error:
+                raise call.error
+            return call.result
+        try:
+            call.result = function(*args)
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.result
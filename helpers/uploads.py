@@ -0,0 +1,89 @@
+import hashlib
+import os
+import uuid
+
+from fastapi import HTTPException, UploadFile
+from fastapi.responses import JSONResponse
+from PIL import Image, UnidentifiedImageError
+
+from helpers.log import logger
+from modules.accessories import env, constants
+
+
+def attachment_variant(path: str) -> str:
+    """Creates a downscaled JPEG copy of an image once, to be used as the email attachment."""
+    variant = os.path.splitext(path)[0] + ".email.jpg"
+    if os.path.isfile(variant):
+        return variant
+    # concurrent uploads of the same image each write their own copy, the last one to finish replaces the others
+    temp_file = f"{variant}.{uuid.uuid4().hex}.part"
+    try:
+        with Image.open(path) as image:
+            image.thumbnail((constants.attachment_pixels, constants.attachment_pixels))
+            image.convert("RGB").save(temp_file, format="JPEG", quality=constants.attachment_quality, optimize=True)
+    except (UnidentifiedImageError, OSError) as error:
+        logger.error("Unable to create an attachment variant for %s: %s", path, error)
+        if os.path.isfile(temp_file):
+            os.remove(temp_file)
+        return path
+    os.replace(temp_file, variant)
+    return variant
+
+
+class UploadLimit:
+    """ASGI middleware that turns away request bodies over ``limit`` bytes on the given paths before they are parsed.
+
+    The multipart parser spools file parts to disk whatever their size, so the declared Content-Length is checked
+    before the handler runs, and bodies sent without one are counted as they arrive.
+    """
+
+    def __init__(self, app, paths: tuple, limit: int):
+        self.app = app
+        self.paths = paths
+        self.limit = limit
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            return await self.app(scope, receive, send)
+        length = dict(scope["headers"]).get(b"content-length")
+        if length and (not length.isdigit() or int(length) > self.limit):
+            response = JSONResponse({"detail": f"request exceeds the limit of {self.limit} bytes"}, status_code=413)
+            return await response(scope, receive, send)
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            received += len(message.get("body", b""))
+            if received > self.limit:
+                # re-raised by the request handler while it parses the form, and answered by the exception handler
+                raise HTTPException(status_code=413, detail=f"request exceeds the limit of {self.limit} bytes")
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+def save_image(image: UploadFile) -> str:
+    """Streams an upload to disk in chunks, stores it under its content hash and returns the attachment path."""
+    extension = image.filename.split(".")[-1].lower() if "." in image.filename else "bin"
+    if not extension.isalnum():
+        raise HTTPException(status_code=400, detail="invalid file extension")
+    hasher, size = hashlib.sha256(), 0
+    temp_file = os.path.join("images", f"{uuid.uuid4().hex}.part")
+    with open(temp_file, "wb") as file:
+        while chunk := image.file.read(constants.upload_chunk):
+            size += len(chunk)
+            if size > env.upload_limit:
+                break
+            hasher.update(chunk)
+            file.write(chunk)
+    if size > env.upload_limit:
+        os.remove(temp_file)
+        raise HTTPException(status_code=413, detail=f"image exceeds the limit of {env.upload_limit} bytes")
+    file_name = os.path.join("images", f"{hasher.hexdigest()}.{extension}")
+    if os.path.isfile(file_name):
+        logger.info("%s has already been uploaded", file_name)
+        os.remove(temp_file)
+    else:
+        os.replace(temp_file, file_name)
+    return attachment_variant(file_name)
@@ -1,9 +1,17 @@
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime
 
-import gmailconnector
+from gmailconnector.validator.address import EmailAddress
+from gmailconnector.validator.domain import get_mx_records
+from gmailconnector.validator.exceptions import (AddressFormatError, InvalidDomain, NotMailServer,
+                                                 UnresponsiveMailServer)
 from pydantic import PositiveInt
 
+from helpers import metrics
 from helpers.log import logger
+from modules.accessories import constants
 
 
 def validate_zip(zipcode: PositiveInt):
@@ -22,22 +30,70 @@ def validate_pw(password):
     return True
 
 
-def validate_email_address(email_address):
-    response = gmailconnector.validate_email(email_address, smtp_check=False)
-    if response.ok is False:
-        logger.error(response.body)
-        return response.body
+class DomainCache:
+    """Bounded LRU of MX lookup results per domain, keeping definite failures for a shorter time than successes."""
 
+    def __init__(self, max_size: int, ttl: int, negative_ttl: int):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
 
-def validate_time(report_time):
+    def get(self, domain: str):
+        """Returns a (cached, error) pair, where error is None for a domain that accepts mail."""
+        with self.lock:
+            entry = self.entries.get(domain)
+            if entry and entry[1] > time.time():
+                self.entries.move_to_end(domain)
+                metrics.inc("cache_requests_total", cache="email_domains", result="hit")
+                return True, entry[0]
+        metrics.inc("cache_requests_total", cache="email_domains", result="miss")
+        return False, None
+
+    def put(self, domain: str, error: str = None):
+        with self.lock:
+            self.entries[domain] = error, time.time() + (self.negative_ttl if error else self.ttl)
+            self.entries.move_to_end(domain)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+
+domain_cache = DomainCache(max_size=constants.domain_cache_size, ttl=constants.domain_ttl,
+                           negative_ttl=constants.domain_negative_ttl)
+
+
+def validate_email_address(email_address):
+    # the address syntax is checked locally, only the domain's MX lookup is worth caching
     try:
-        return datetime.strptime(report_time, "%H%M")
-    except ValueError as error:
+        domain = EmailAddress(address=email_address).domain.lower()
+    except AddressFormatError as error:
         logger.error(error)
-    try:
-        return datetime.strptime(report_time, "%I:%M %p")
-    except ValueError as error:
+        return f"Invalid address: {email_address!r}. {error}".rstrip(". ") + "."
+    cached, error = domain_cache.get(domain)
+    if not cached:
+        try:
+            list(get_mx_records(domain=domain))
+        except (InvalidDomain, NotMailServer) as definite:
+            error = definite.__str__()
+            domain_cache.put(domain, error)
+        except UnresponsiveMailServer as transient:
+            # a resolver hiccup on the MX host says nothing about the domain, so only this signup is turned away
+            error = transient.__str__()
+        else:
+            domain_cache.put(domain)
+    if error:
         logger.error(error)
+        return error
+
+
+def validate_time(report_time):
+    for time_format in ("%H%M", "%I:%M %p"):
+        try:
+            return datetime.strptime(report_time, time_format)
+        except ValueError as error:
+            last_error = error
+    logger.error(last_error)
 
 
 def validate_frequency(frequency):
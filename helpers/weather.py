@@ -1,21 +1,154 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
+from fastapi import HTTPException
+from geopy.exc import GeopyError
 from pydantic import PositiveInt
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 
+from helpers import metrics
 from helpers.location import get_coordinates
 from helpers.log import logger
-from modules.accessories import env
+from helpers.throttle import SingleFlight, TokenBucket
+from modules.accessories import env, constants
+
+url = env.weather_host + "/data/2.5/weather?lat={lat}&lon={lon}&appid={apikey}&units=imperial"
+
+
+class WeatherCache:
+    """Weather responses keyed by zipcode with a TTL, shared between processes through an atomically replaced file."""
+
+    def __init__(self, filename: str, ttl: int, max_size: int):
+        self.filename = filename
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.modified = 0
+        self.dirty = False
+        self.lock = threading.Lock()
+
+    def load(self):
+        """Merges entries written by other processes, if the file changed since it was last read."""
+        try:
+            modified = os.path.getmtime(self.filename)
+        except OSError:
+            return
+        if modified == self.modified:
+            return
+        self.modified = modified
+        try:
+            with open(self.filename) as file:
+                stored = json.load(file)
+        except (OSError, ValueError) as error:
+            logger.error(error)
+            return
+        for zipcode, entry in stored.get("entries", {}).items():
+            if isinstance(entry, dict) and entry.get("time", 0) > self.entries.get(zipcode, {}).get("time", 0):
+                self.entries[zipcode] = entry
+
+    def get(self, zipcode: PositiveInt, max_age: int = None):
+        """Returns the cached weather if it is younger than the TTL, or than ``max_age`` when that is shorter."""
+        self.load()
+        entry = self.entries.get(str(zipcode))
+        if entry and time.time() - entry["time"] < min(self.ttl, max_age or self.ttl):
+            self.entries.move_to_end(str(zipcode))
+            metrics.inc("cache_requests_total", cache="weather", result="hit")
+            return entry["data"]
+        metrics.inc("cache_requests_total", cache="weather", result="miss")
+
+    def put(self, zipcode: PositiveInt, data: dict):
+        with self.lock:
+            self.entries[str(zipcode)] = {"time": time.time(), "data": data}
+            self.entries.move_to_end(str(zipcode))
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+            self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        now = time.time()
+        with self.lock:
+            for zipcode in [key for key, entry in self.entries.items() if now - entry["time"] >= self.ttl]:
+                del self.entries[zipcode]
+            entries = dict(self.entries)
+        temp_file = f"{self.filename}.{os.getpid()}.tmp"
+        with open(temp_file, "w") as file:
+            json.dump({"last_updated_time": time.strftime("%c"), "entries": entries}, file, indent=4)
+        os.replace(temp_file, self.filename)
+        self.modified = os.path.getmtime(self.filename)
+        self.dirty = False
 
-url = "https://api.openweathermap.org/data/2.5/weather?lat={lat}&lon={lon}&appid={apikey}&units=imperial"
 
+weather_cache = WeatherCache(filename=constants.weather_file, ttl=env.weather_ttl,
+                             max_size=constants.weather_cache_size)
 
-def get_weather(zipcode: PositiveInt):
-    if location_details := get_coordinates(zipcode):
-        latitude, longitude = location_details
-    else:
-        logger.error("Failed to get location co-ordinations for the zipcode %s", zipcode)
-        return
+
+session = requests.Session()
+adapter = HTTPAdapter(pool_connections=1, pool_maxsize=env.weather_workers,
+                      max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504)))
+session.mount("https://", adapter)
+session.mount("http://", adapter)
+# 429s are left to the limiter, which slows every worker down instead of each retrying on its own
+weather_limiter = TokenBucket(rate=env.weather_rate, capacity=env.weather_rate)
+weather_flight = SingleFlight("weather")
+
+
+def fetch_weather(latitude: float, longitude: float):
     weather_url = url.format(lat=latitude, lon=longitude, apikey=env.weather_api)
-    response = requests.get(url=weather_url)
-    if response.ok:
-        return response.json()
-    response.raise_for_status()
+    try:
+        for _ in range(constants.upstream_attempts):
+            weather_limiter.acquire()
+            with metrics.timer("upstream_seconds", upstream="weather"):
+                response = session.get(url=weather_url, timeout=env.weather_timeout)
+            if response.status_code != 429:
+                break
+            metrics.inc("upstream_throttled_total", upstream="weather")
+            weather_limiter.backoff(response.headers.get("Retry-After"))
+        response.raise_for_status()
+    except requests.RequestException:
+        metrics.inc("upstream_errors_total", upstream="weather")
+        raise
+    weather_limiter.recover()
+    return response.json()
+
+
+def refresh_weather(zipcode: PositiveInt, location: tuple):
+    current = fetch_weather(*location)
+    weather_cache.put(zipcode, current)
+    return current
+
+
+@metrics.timed("weather_seconds")
+def get_weather_many(zipcodes, max_age: int = None) -> dict:
+    """Fetches weather for all the zipcodes concurrently, skipping cached ones and those that fail.
+
+    ``max_age`` narrows the cache TTL, so alert checks more frequent than the TTL still see fresh data.
+    Coordinates are resolved on the calling thread, so only the weather requests fan out to the pool.
+    """
+    weather, locations = {}, {}
+    for zipcode in set(zipcodes):
+        if current := weather_cache.get(zipcode, max_age):
+            weather[zipcode] = current
+            continue
+        try:
+            locations[zipcode] = get_coordinates(zipcode)
+        except (GeopyError, HTTPException) as error:
+            logger.error("Failed to get location co-ordinations for the zipcode %s: %s", zipcode, error)
+    if not locations:
+        return weather
+    with ThreadPoolExecutor(max_workers=min(env.weather_workers, len(locations))) as executor:
+        futures = {zipcode: executor.submit(weather_flight.do, zipcode, refresh_weather, zipcode, location)
+                   for zipcode, location in locations.items()}
+    for zipcode, future in futures.items():
+        try:
+            weather[zipcode] = future.result()
+        except requests.RequestException as error:
+            logger.error("Failed to get weather for the zipcode %s: %s", zipcode, error)
+    return weather
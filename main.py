@@ -1,44 +1,71 @@
-import json
 import os
 import secrets
 import time
 from contextlib import asynccontextmanager
 from datetime import datetime
 from multiprocessing import Process
+from typing import List
 
 import uvicorn
-import yaml
-from fastapi import FastAPI, HTTPException, UploadFile, Form, Request
-from fastapi.responses import RedirectResponse, HTMLResponse, FileResponse
-from fastapi.templating import Jinja2Templates
+from anyio import to_thread
+from fastapi import FastAPI, HTTPException, UploadFile, Form, Request, Response, Query
+from fastapi.responses import RedirectResponse, HTMLResponse, PlainTextResponse, StreamingResponse
 from pydantic import PositiveInt, EmailStr
 
-from helpers import log, support, tokenizer, bgtasks
-from modules.accessories import constants
-from modules.database import db
+from helpers import assets, bulk, log, support, tokenizer, bgtasks, mailer, casting, uploads, metrics, sessions, push
+from helpers.location import zip_index
+from modules import database
+from modules.accessories import env, constants
 
 
 @asynccontextmanager
 async def lifespan(_: FastAPI):
-    # Load the ML model
+    # blocking handlers (sqlite, smtp queue, geocoding) are declared with def and run on this bounded pool
+    to_thread.current_default_thread_limiter().total_tokens = env.io_workers
     logger.info("Initiating background task")
     Process(target=bgtasks.background_task).start()
+    mailer.start()
+    metrics.start()
     yield
 
 
 app = FastAPI(lifespan=lifespan)
+# leaves room for the other form fields next to an image of the maximum size
+app.add_middleware(uploads.UploadLimit, paths=("/publish-info",), limit=env.upload_limit + constants.upload_chunk)
 logger = log.logger
-templates = Jinja2Templates(directory="UI")
+
+
+@app.middleware("http")
+async def record_latency(request: Request, call_next):
+    """This function records the latency of every request by route."""
+    start = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    metrics.observe("request_seconds", time.perf_counter() - start, route=route.path if route else "unmatched",
+                    method=request.method, status=response.status_code)
+    return response
+
+
+def require_admin(request: Request):
+    """This function rejects requests without the ADMIN_TOKEN bearer token, and all of them when it is unset."""
+    authorization = request.headers.get("authorization", "").encode()
+    if not env.admin_token or not secrets.compare_digest(authorization, f"Bearer {env.admin_token}".encode()):
+        raise HTTPException(status_code=403, detail="admin token required")
+
+
+@app.get("/metrics", include_in_schema=False)
+def prometheus_metrics():
+    """This function exposes the metrics of every process in Prometheus text format."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
 
 @app.get("/images/{image_name}")
-async def images(image_name):
-    """This function is dedicated to serving images to the UI."""
-    img_path = os.path.join("UI", image_name)
-    if os.path.isfile(img_path):
-        return FileResponse(path=img_path)
-    else:
-        logger.error("%s is missing", img_path)
+async def images(request: Request, image_name: str):
+    """This function is dedicated to serving images to the UI from memory, answering revalidations with 304."""
+    if asset := assets.get_file(image_name):
+        return assets.respond(request, asset)
+    logger.error("%s is missing", os.path.join(constants.ui_dir, image_name))
+    raise HTTPException(status_code=404, detail=f"{image_name} not found")
 
 
 @app.get("/", include_in_schema=False)
@@ -53,175 +80,153 @@ async def health():
     return {"OK": True}
 
 
+@app.get("/health/scheduler")
+def scheduler_health():
+    """This function reports which process holds the background scheduler lease."""
+    lease = database.get_lease("scheduler")
+    if not lease:
+        return {"holder": None, "healthy": False}
+    return {"holder": lease[0], "expires_in": round(lease[1] - time.time(), 1), "healthy": lease[1] > time.time()}
+
+
+@app.get("/crowd-casts")
+async def crowd_casts(request: Request):
+    """This function lists the queued, running and recently finished crowd casts to administrators."""
+    require_admin(request)
+    return casting.status()
+
+
+@app.get("/crowd-casts/stream")
+async def crowd_cast_stream(request: Request, zipcode: List[PositiveInt] = Query(None)):
+    """This function streams crowd casts near the zipcodes, or the user's own ones, to a signed in dashboard."""
+    userid, zipcodes = await to_thread.run_sync(push.authorize, request, zipcode)
+    if userid in await to_thread.run_sync(support.get_blocked):
+        raise HTTPException(status_code=403, detail='user blocked')
+    return StreamingResponse(push.events(userid, zipcodes), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
 @app.post("/create-alert")
-async def create_alert(email_address: EmailStr = Form(...), password: str = Form(...),
-                       zipcode: PositiveInt = Form(...),
-                       report_time: str = Form(...), frequency: int = Form(None), otp: str = Form(None),
-                       accept_crowd_sourcing: bool = Form(True)):
+def create_alert(request: Request, email_address: EmailStr = Form(...), password: str = Form(...),
+                 zipcode: PositiveInt = Form(...),
+                 report_time: str = Form(...), frequency: int = Form(None), otp: str = Form(None),
+                 accept_crowd_sourcing: bool = Form(True)):
     """This function gets the information from the user."""
     logger.info("Email: %s", email_address)
     logger.info("ZIP Code: %s", zipcode)
     logger.info("Report Time: %s", report_time)
     logger.info("Frequency %s", frequency)
-    validation_result = support.validations(email_address, password, zipcode,
-                                            report_time, frequency, otp, accept_crowd_sourcing)
+    validation_result = support.validations(email_address, password, zipcode, report_time, frequency, otp,
+                                            accept_crowd_sourcing, sessions.from_request(request))
 
     return validation_result
 
 
 @app.post("/publish-info")
-async def publish_info(request: Request, email_address: EmailStr = Form(...), password: str = Form(...),
-                       description: str = Form(...), zipcode: PositiveInt = Form(...), image: UploadFile = None):
+def publish_info(request: Request, email_address: EmailStr = Form(...), password: str = Form(None),
+                 description: str = Form(...), zipcode: PositiveInt = Form(...), image: UploadFile = None):
     """This function gets the information for crowdsourcing"""
     logger.info("Email: %s", email_address)
     logger.info("ZIP Code: %s", zipcode)
-    with db.connection:
-        cursor = db.connection.cursor()
-        retrieve = cursor.execute(
-            "SELECT userid, password FROM container WHERE email_address=?;", (email_address,)
-        ).fetchone()
-    if not retrieve:
-        logger.info("not retrieved 404")
-        raise HTTPException(status_code=404, detail=f"{email_address} is currently not "
-                                                    "subscribed to WeatherTogether")
-    sender_id = retrieve[0]
+    sender_id = support.authenticate(email_address, password, sessions.from_request(request))
     if sender_id in support.get_blocked():
         raise HTTPException(status_code=403, detail='user blocked')
-    stored_pw = tokenizer.hex_decode(retrieve[1])
-    if secrets.compare_digest(password, stored_pw):
-        logger.info("'%s' with user id '%d' has been authenticated", email_address, sender_id)
-    else:
-        raise HTTPException(status_code=401, detail="invalid email address or password")
-    if not retrieve:
-        raise HTTPException(status_code=400, detail="email not found in db: %s" % email_address)
+    logger.info("'%s' with user id '%d' has been authenticated", email_address, sender_id)
     if not description:
         raise HTTPException(status_code=404, detail="description is required")
     if image:
-        extension = image.filename.split(".")[-1]
-        file_name = os.path.join("images", str(int(time.time())) + "." + extension)
-        with open(file_name, "wb") as file:
-            file.write(await image.read())
+        file_name = uploads.save_image(image)
     else:
         file_name = ""
     report_url = f"{request.base_url}report/{sender_id}/"
-    logger.info("Starting bg process for crowdcasting")
-    Process(target=support.crowd_cast, args=(zipcode, description, file_name, report_url)).start()
+    job_id = casting.submit(zipcode, description, file_name, report_url)
+    logger.info("Queued crowd cast %d", job_id)
     raise HTTPException(status_code=200, detail="email found: %s" % email_address)
 
 
 @app.delete(path="/unsubscribe")  # deletes everything rn
-async def unsubscribe(email_address: EmailStr = Form(...), password: str = Form(...), everything: bool = True):
-    with db.connection:
-        logger.info("starting delete")
-        cursor = db.connection.cursor()
-        retrieve = cursor.execute(
-            "SELECT userid, password FROM container WHERE email_address=?;", (email_address,)
-        ).fetchone()
-        if not retrieve:
-            logger.info("not in db")
-            raise HTTPException(status_code=404, detail=f"{email_address} is currently not "
-                                                        "subscribed to WeatherTogether")
-        if secrets.compare_digest(password, tokenizer.hex_decode(retrieve[1])):
-            if everything:
-                logger.info("delete everything")
-                cursor.execute(
-                    "DELETE FROM container WHERE email_address=?;", (email_address,)
-                )
-            else:
-                cursor.execute(
-                    "UPDATE container SET crowdsource_button=0 WHERE email_address=?;", (email_address,)
-                )
-            db.connection.commit()
-            if everything:
-                logger.info("unsubscribe successful for %s", email_address)
-                raise HTTPException(status_code=200, detail="Successfully unsubscribed from WeatherTogether")
-            else:
-                raise HTTPException(status_code=200, detail="CrowdSourcing has been disabled")
-        else:
-            raise HTTPException(status_code=401, detail="invalid email address or password")
+def unsubscribe(request: Request, email_address: EmailStr = Form(...), password: str = Form(None),
+                everything: bool = True):
+    logger.info("starting delete")
+    userid = support.authenticate(email_address, password, sessions.from_request(request))
+    if everything:
+        logger.info("delete everything")
+        for zipcode in database.delete_user(email_address):
+            if not database.has_zipcode(zipcode):
+                zip_index.remove(zipcode)
+        sessions.active_users.forget(userid, email_address)
+        logger.info("unsubscribe successful for %s", email_address)
+        raise HTTPException(status_code=200, detail="Successfully unsubscribed from WeatherTogether")
+    else:
+        database.disable_crowdsourcing(email_address)
+        raise HTTPException(status_code=200, detail="CrowdSourcing has been disabled")
 
 
 @app.get("/report/{block_id}/{user_id}")
-async def report_spam(block_id: str, user_id: str):
+def report_spam(block_id: str, user_id: str):
     block_id = int(block_id)
     user_id = int(user_id)
-    if os.path.isfile(constants.blocked_file):
-        with open(constants.blocked_file) as file:
-            blocked_already = json.load(file)
-        if block_id in blocked_already:
-            raise HTTPException(status_code=200, detail="reported user is already blocked")
-    if os.path.isfile(constants.report_file):
-        with open(constants.report_file) as file:
-            data = yaml.load(file, Loader=yaml.FullLoader)
-    else:
-        data = {}
-    if data.get(block_id):
-        if user_id in data[block_id]:
-            logger.warning("duplicate report on %d by %d", block_id, user_id)
-        else:
-            data[block_id].append(user_id)
-    else:
-        data[block_id] = [user_id]
-    if len(data[block_id]) >= constants.report_threshold:
-        if os.path.isfile(constants.blocked_file):
-            with open(constants.blocked_file) as file:
-                blocked = json.load(file)
-        else:
-            blocked = []
-        blocked.append(block_id)
-        with open(constants.blocked_file, "w") as file:
-            json.dump(blocked, file)
-        del data[block_id]
-        with db.connection:
-            cursor = db.connection.cursor()
-            retrieve = cursor.execute(
-                "SELECT email_address FROM container WHERE userid=?;", (block_id,)
-            ).fetchone()
-        support.email_object.send_email(recipient=retrieve[0],
-                                        subject=f"WeatherTogether - Report received {datetime.now().strftime('%c')}",
-                                        sender="WeatherTogether",
-                                        body="\n\nDue to multiple reports, you have been blocked from WeatherTogether."
-                                             "\n\nYou will no longer be able to receive daily weather reports, "
-                                             "severe weather alerts nor will you have the ability to participate in "
-                                             "crowd casting")
-    with open(constants.report_file, "w") as file:
-        yaml.dump(data=data, stream=file, indent=4)
+    if block_id in support.get_blocked():
+        raise HTTPException(status_code=200, detail="reported user is already blocked")
+    if support.block_user(block_id, user_id) and (recipient := database.get_email(block_id)):
+        mailer.enqueue(recipient=recipient,
+                       subject=f"WeatherTogether - Report received {datetime.now().strftime('%c')}",
+                       body="\n\nDue to multiple reports, you have been blocked from WeatherTogether."
+                            "\n\nYou will no longer be able to receive daily weather reports, "
+                            "severe weather alerts nor will you have the ability to participate in "
+                            "crowd casting")
     return {"OK": "User ID reported"}
 
 
+@app.post("/admin/subscriptions")
+async def import_subscriptions(request: Request):
+    """This function imports subscriptions streamed as NDJSON, or as CSV with a header row."""
+    require_admin(request)
+    csv_format = "csv" in request.headers.get("content-type", "")
+    with await bulk.spool(request) as upload:
+        return await to_thread.run_sync(bulk.import_subscriptions, bulk.read_records(upload, csv_format))
+
+
+@app.get("/admin/subscriptions")
+def export_subscriptions(request: Request, format: str = "ndjson"):
+    """This function streams every subscription, without passwords, as NDJSON or CSV."""
+    require_admin(request)
+    if format not in ("ndjson", "csv"):
+        raise HTTPException(status_code=400, detail="format must be ndjson or csv")
+    return StreamingResponse(bulk.export_subscriptions(format == "csv"),
+                             media_type="text/csv" if format == "csv" else "application/x-ndjson")
+
+
 @app.get("/login", response_class=HTMLResponse)
 async def login_page(request: Request):
-    return templates.TemplateResponse("loginPage.html", {"request": request})
+    return assets.respond(request, assets.get_page("loginPage.html"))
 
 
 @app.post("/login_verify")
-async def login_verify(email_address: EmailStr = Form(...), password: str = Form(...)):
+def login_verify(response: Response, email_address: EmailStr = Form(...), password: str = Form(...)):
+    """This function verifies the credentials and starts a session, sent as a cookie and in the body."""
     logger.info("logged in as %s", email_address)
-    cursor = db.connection.cursor()
-    retrieve = cursor.execute(
-        "SELECT userid, password FROM container WHERE email_address=?;", (email_address,)
-    ).fetchone()
+    retrieve = database.get_user(email_address)
     if not retrieve:
         logger.info("not in db")
         raise HTTPException(status_code=404, detail=f"{email_address} is currently not "
                                                     "subscribed to WeatherTogether")
     db_password = tokenizer.hex_decode(retrieve[1])
-
-    logger.info(db_password)
-    if password != db_password:
+    if not secrets.compare_digest(password, db_password):
         raise HTTPException(status_code=401, detail="Invalid email or password")
-
-    return {"OK": "email and pass are verified"}
+    token = sessions.issue(retrieve[0], email_address)
+    response.set_cookie(sessions.COOKIE, token, max_age=constants.session_ttl, httponly=True, samesite="strict")
+    return {"OK": "email and pass are verified", "token": token}
 
 
 @app.get("/weather", response_class=HTMLResponse)
 async def confirmation_page(request: Request):
-    return templates.TemplateResponse("weather.html", {"request": request})
+    return assets.respond(request, assets.get_page("weather.html"))
 
 
 @app.get("/userHomePage", response_class=HTMLResponse)
 async def home_page(request: Request):
-    return templates.TemplateResponse("userHomePage.html", {"request": request})
+    return assets.respond(request, assets.get_page("userHomePage.html"))
 
 
 if __name__ == "__main__":
@@ -1,4 +1,5 @@
 import os
+from multiprocessing import Queue
 
 from pydantic import BaseModel
 from pydantic_settings import BaseSettings
@@ -13,6 +14,47 @@ class Constants(BaseModel):
     blocked_file: str = "blocked.json"
     report_file: str = "report_ids.yaml"
     report_threshold: int = 3
+    blocked_refresh: int = 60
+    otp_ttl: int = 300
+    otp_attempts: int = 5
+    zipcode_file: str = "zipcodes.csv"
+    index_refresh: int = 60
+    weather_file: str = "weather_file.json"
+    weather_cache_size: int = 10_000
+    alert_frequency: int = 30
+    alert_expiry: int = 21_600
+    schedule_resync: int = 300
+    lease_ttl: int = 60
+    email_poll: int = 5
+    email_attempts: int = 5
+    email_stale: int = 600
+    upstream_attempts: int = 3
+    cast_backlog: int = 100
+    cast_history: int = 100
+    upload_chunk: int = 1 << 16
+    attachment_pixels: int = 1_280
+    attachment_quality: int = 80
+    metrics_dir: str = "metrics"
+    metrics_flush: int = 10
+    page_size: int = 500
+    ui_dir: str = "UI"
+    asset_max_age: int = 86_400
+    push_backlog: int = 100
+    push_keepalive: int = 15
+    push_connections: int = 10_000
+    push_zipcodes: int = 10
+    push_confirm: float = 2.0
+    import_records: int = 100_000
+    import_batch: int = 1_000
+    import_spool: int = 1_048_576
+    import_errors: int = 100
+    domain_cache_size: int = 1_024
+    domain_ttl: int = 3_600
+    domain_negative_ttl: int = 300
+    session_ttl: int = 86_400
+    session_cache_size: int = 1_024
+    session_secret_file: str = "session.secret"
+    session_secret_reads: int = 20
 
 
 class EnvVar(BaseSettings):
@@ -20,6 +62,27 @@ class EnvVar(BaseSettings):
     email_username: str
     email_password: str
     casting_distance: int = 5
+    weather_host: str = "https://api.openweathermap.org"
+    geocoder_domain: str = "nominatim.openstreetmap.org"
+    weather_ttl: int = 1_800
+    weather_timeout: int = 10
+    weather_workers: int = 16
+    weather_rate: float = 10.0
+    geocoder_rate: float = 1.0
+    smtp_host: str = "smtp.gmail.com"
+    smtp_port: int = 587
+    smtp_starttls: bool = True
+    email_workers: int = 4
+    email_rate: float = 5.0
+    cast_workers: int = 4
+    io_workers: int = 40
+    upload_limit: int = 10 << 20
+    log_level: str = "INFO"
+    log_levels: str = ""
+    log_json: bool = False
+    log_retention: int = 7
+    session_secret: str = ""
+    admin_token: str = ""
 
     class Config:
         """Environment variables configuration."""
@@ -32,4 +95,4 @@ env = EnvVar()
 if not os.path.isdir("images"):
     os.mkdir("images")
 
-otp_dict = {}
+schedule_queue = Queue()
@@ -1,21 +1,592 @@
+import csv
+import functools
+import json
+import os
+import secrets
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
 
-from modules.accessories import user_data
+import yaml
+
+from modules.accessories import user_data, constants
+
+# Query timings are reported through this hook, which helpers.metrics installs on import, so the data layer does
+# not depend on the helpers built on top of it.
+observe = None
+
+
+@contextmanager
+def timer(function: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if observe:
+            observe("db_query_seconds", time.perf_counter() - start, function=function)
+
+
+def timed(function):
+    """Reports how long each call to a query function takes, labelled with the function name."""
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with timer(function.__name__):
+            return function(*args, **kwargs)
+    return wrapper
+
+
+# Each entry upgrades the schema by one version, tracked with PRAGMA user_version.
+migrations = (
+    # 1: typed subscriber table keyed on (email_address, zipcode); copies over the original untyped table
+    f"""
+    CREATE TABLE IF NOT EXISTS container {user_data.user_input};
+    ALTER TABLE container RENAME TO container_legacy;
+    CREATE TABLE container (
+        userid INTEGER NOT NULL,
+        email_address TEXT NOT NULL,
+        password TEXT NOT NULL,
+        zipcode INTEGER NOT NULL,
+        report_time TEXT,
+        frequency INTEGER,
+        crowdsource_button INTEGER NOT NULL DEFAULT 1,
+        PRIMARY KEY (email_address, zipcode)
+    );
+    INSERT or REPLACE INTO container SELECT {', '.join(user_data.user_input)} FROM container_legacy;
+    DROP TABLE container_legacy;
+    CREATE INDEX container_userid ON container (userid);
+    CREATE INDEX container_zipcode ON container (zipcode);
+    CREATE INDEX container_report_time ON container (report_time);
+    CREATE TABLE IF NOT EXISTS coordinates (zipcode INTEGER PRIMARY KEY, latitude REAL, longitude REAL);
+    CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, recipient TEXT, subject TEXT, body TEXT, attachment TEXT,
+        status TEXT DEFAULT 'queued', attempts INTEGER DEFAULT 0, available REAL DEFAULT 0, error TEXT
+    );
+    CREATE INDEX IF NOT EXISTS outbox_status ON outbox (status, available);
+    """,
+    # 2: blocked users and spam reports, previously kept in blocked.json and report_ids.yaml
+    """
+    CREATE TABLE blocked (userid INTEGER PRIMARY KEY);
+    CREATE TABLE reports (block_id INTEGER NOT NULL, user_id INTEGER NOT NULL, PRIMARY KEY (block_id, user_id));
+    """,
+    # 3: one time passcodes shared by every worker process
+    """
+    CREATE TABLE otp (email_address TEXT PRIMARY KEY, code TEXT NOT NULL, expires REAL NOT NULL,
+                      attempts INTEGER NOT NULL DEFAULT 0);
+    CREATE INDEX otp_expires ON otp (expires);
+    """,
+    # 4: leases for work that must run in exactly one process per deployment
+    """
+    CREATE TABLE lease (name TEXT PRIMARY KEY, holder TEXT NOT NULL, expires REAL NOT NULL);
+    """,
+    # 5: severe weather alerts already sent to each zipcode, per alert frequency
+    """
+    CREATE TABLE alert_state (zipcode INTEGER NOT NULL, frequency INTEGER NOT NULL, digest TEXT NOT NULL,
+                              expires REAL NOT NULL, PRIMARY KEY (zipcode, frequency, digest));
+    CREATE INDEX alert_state_expires ON alert_state (expires);
+    """,
+    # 6: data files imported into the database, with the size and modification time they had at the time
+    """
+    CREATE TABLE imports (name TEXT PRIMARY KEY, signature TEXT NOT NULL);
+    """,
+)
+
+
+def split_statements(script: str):
+    """Splits a migration script into single statements, since executescript would commit the open transaction."""
+    statement = ""
+    for piece in script.split(";"):
+        statement += piece + ";"
+        if sqlite3.complete_statement(statement):
+            if statement.strip(" \n;"):
+                yield statement.strip()
+            statement = ""
 
 
 class DB:
     def __init__(self):
-        self.connection = sqlite3.connect(database="datastore.db")
-        self.connection.execute(f"CREATE TABLE IF NOT EXISTS container {user_data.user_input}")
+        self.local = threading.local()
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.migrate()
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """Connection owned by the current thread, re-opened after a fork since sqlite handles cannot be shared."""
+        if getattr(self.local, "pid", None) != os.getpid():
+            self.local.connection = sqlite3.connect(database="datastore.db", timeout=30)
+            self.local.connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.pid = os.getpid()
+        return self.local.connection
+
+    def migrate(self):
+        """Applies pending migrations one per transaction, reading the version only once the write lock is held.
+
+        Every worker runs this at startup, so a worker that waited on the lock sees the version another one just
+        wrote and skips the steps that are already applied.
+        """
+        upgraded_from = None
+        while True:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+                if version >= len(migrations):
+                    self.connection.commit()
+                    break
+                for statement in split_statements(migrations[version]):
+                    self.connection.execute(statement)
+                self.connection.execute(f"PRAGMA user_version={version + 1}")
+                self.connection.commit()
+            except BaseException:
+                self.connection.rollback()
+                raise
+            if upgraded_from is None:
+                upgraded_from = version
+        if upgraded_from is not None and upgraded_from < 2 <= len(migrations):
+            self.import_reports()
+
+    def import_reports(self):
+        """Copies blocked users and pending reports from the legacy json/yaml files into their tables."""
+        blocked, reports = [], {}
+        if os.path.isfile(constants.blocked_file):
+            with open(constants.blocked_file) as file:
+                blocked = json.load(file)
+        if os.path.isfile(constants.report_file):
+            with open(constants.report_file) as file:
+                reports = yaml.load(file, Loader=yaml.FullLoader) or {}
+        with self.connection:
+            self.connection.executemany("INSERT or IGNORE INTO blocked (userid) VALUES (?);",
+                                        [(userid,) for userid in blocked])
+            self.connection.executemany("INSERT or IGNORE INTO reports (block_id, user_id) VALUES (?,?);",
+                                        [(block_id, user_id) for block_id, user_ids in reports.items()
+                                         for user_id in user_ids])
 
 
 db = DB()
 
 
-def get_existing_info():
+@timed
+def get_user(email_address: str):
+    """Returns the userid and encoded password for an email address."""
+    with db.connection:
+        cursor = db.connection.cursor()
+        retrieve = cursor.execute(
+            "SELECT userid, password FROM container WHERE email_address=? LIMIT 1;", (email_address,)
+        ).fetchone()
+    return retrieve
+
+
+@timed
+def get_email(userid: int):
+    with db.connection:
+        cursor = db.connection.cursor()
+        retrieve = cursor.execute(
+            "SELECT email_address FROM container WHERE userid=? LIMIT 1;", (userid,)
+        ).fetchone()
+    return retrieve[0] if retrieve else None
+
+
+@timed
+def get_subscriptions(email_address: str):
+    with db.connection:
+        cursor = db.connection.cursor()
+        retrieve = cursor.execute(
+            f"SELECT {', '.join(user_data.user_input)} FROM container WHERE email_address=?;", (email_address,)
+        ).fetchall()
+    return retrieve
+
+
+@timed
+def put_subscription(userid: int, email_address: str, password: str, zipcode: int, report_time: str,
+                     frequency: int, crowdsource_button: bool):
+    with db.connection:
+        cursor = db.connection.cursor()
+        cursor.execute(
+            f"INSERT or REPLACE INTO container {user_data.user_input} VALUES (?,?,?,?,?,?,?);",
+            (userid, email_address, password, zipcode, report_time, frequency, crowdsource_button)
+        )
+
+
+@timed
+def next_userid(now: float) -> int:
+    """Userids follow the signup time, but never reuse one handed out by a bulk import ahead of the clock."""
+    with db.connection:
+        cursor = db.connection.cursor()
+        retrieve = cursor.execute("SELECT COALESCE(MAX(userid), 0) FROM container;").fetchone()
+    return max(int(now), retrieve[0] + 1)
+
+
+@timed
+def put_subscriptions(rows: list, blocked: set, now: float) -> tuple:
+    """Imports (email_address, password, zipcode, report_time, frequency, crowdsource_button) rows in one transaction.
+
+    Addresses that are already subscribed keep their userid and password, and blocked ones are skipped.
+    Returns the rows that were written and the addresses that are new.
+    """
+    with db.connection:
+        cursor = db.connection.cursor()
+        existing = {email_address: (userid, password) for email_address, userid, password in cursor.execute(
+            "SELECT email_address, userid, password FROM container WHERE email_address IN "
+            "(SELECT value FROM json_each(?));", (json.dumps(list({row[0] for row in rows})),)
+        )}
+        userid = max(int(now), cursor.execute("SELECT COALESCE(MAX(userid), 0) FROM container;").fetchone()[0] + 1)
+        written, new = [], []
+        for email_address, password, *schedule in rows:
+            if email_address not in existing:
+                existing[email_address] = userid, password
+                new.append(email_address)
+                userid += 1
+            if existing[email_address][0] in blocked:
+                continue
+            written.append((existing[email_address][0], email_address, existing[email_address][1], *schedule))
+        cursor.executemany(
+            f"INSERT or REPLACE INTO container {user_data.user_input} VALUES (?,?,?,?,?,?,?);", written
+        )
+    return written, new
+
+
+@timed
+def update_schedule(email_address: str, zipcode: int, report_time: str, frequency: int):
+    with db.connection:
+        cursor = db.connection.cursor()
+        cursor.execute(
+            "UPDATE container SET report_time=?, frequency=? WHERE email_address=? AND zipcode=?;",
+            (report_time, frequency, email_address, zipcode)
+        )
+
+
+@timed
+def delete_user(email_address: str) -> list:
+    """Deletes every subscription of an email address and returns the zipcodes it held."""
+    with db.connection:
+        cursor = db.connection.cursor()
+        retrieve = cursor.execute(
+            "DELETE FROM container WHERE email_address=? RETURNING zipcode;", (email_address,)
+        ).fetchall()
+    return list({each[0] for each in retrieve})
+
+
+@timed
+def disable_crowdsourcing(email_address: str):
+    with db.connection:
+        cursor = db.connection.cursor()
+        cursor.execute(
+            "UPDATE container SET crowdsource_button=0 WHERE email_address=?;", (email_address,)
+        )
+
+
+@timed
+def get_blocked() -> set:
+    with db.connection:
+        cursor = db.connection.cursor()
+        retrieve = cursor.execute(
+            "SELECT userid FROM blocked"
+        ).fetchall()
+    return {each[0] for each in retrieve}
+
+
+@timed
+def put_report(block_id: int, user_id: int, threshold: int):
+    """Records a report and blocks the user once the threshold is reached.
+
+    Returns a tuple of flags indicating whether the report was a duplicate and whether the user got blocked.
+    """
+    with db.connection:
+        cursor = db.connection.cursor()
+        duplicate = not cursor.execute(
+            "INSERT or IGNORE INTO reports (block_id, user_id) VALUES (?,?);", (block_id, user_id)
+        ).rowcount
+        count = cursor.execute("SELECT COUNT(*) FROM reports WHERE block_id=?;", (block_id,)).fetchone()[0]
+        if count < threshold:
+            return duplicate, False
+        cursor.execute("INSERT or IGNORE INTO blocked (userid) VALUES (?);", (block_id,))
+        cursor.execute("DELETE FROM reports WHERE block_id=?;", (block_id,))
+    return duplicate, True
+
+
+@timed
+def put_otp(email_address: str, code: str, expires: float, now: float):
+    """Stores a passcode, replacing any previous one for the address and purging expired ones."""
+    with db.connection:
+        cursor = db.connection.cursor()
+        cursor.execute("DELETE FROM otp WHERE expires<?;", (now,))
+        cursor.execute(
+            "INSERT or REPLACE INTO otp (email_address, code, expires, attempts) VALUES (?,?,?,0);",
+            (email_address, code, expires)
+        )
+
+
+@timed
+def check_otp(email_address: str, code: str, now: float, max_attempts: int) -> bool:
+    """Verifies a passcode, consuming it on success and after too many failed attempts.
+
+    The read and the update share one write transaction, so concurrent guesses cannot exceed the attempt limit
+    or consume the same code twice.
+    """
+    with db.connection:
+        cursor = db.connection.cursor()
+        cursor.execute("BEGIN IMMEDIATE;")
+        retrieve = cursor.execute(
+            "SELECT code, attempts FROM otp WHERE email_address=? AND expires>=?;", (email_address, now)
+        ).fetchone()
+        if not retrieve:
+            return False
+        if secrets.compare_digest(retrieve[0], code):
+            cursor.execute("DELETE FROM otp WHERE email_address=?;", (email_address,))
+            return True
+        if retrieve[1] + 1 >= max_attempts:
+            cursor.execute("DELETE FROM otp WHERE email_address=?;", (email_address,))
+        else:
+            cursor.execute("UPDATE otp SET attempts=attempts+1 WHERE email_address=?;", (email_address,))
+    return False
+
+
+@timed
+def acquire_lease(name: str, holder: str, ttl: int, now: float) -> bool:
+    """Takes or renews a lease, succeeding only if it is free, expired or already held by the holder."""
+    with db.connection:
+        cursor = db.connection.cursor()
+        cursor.execute(
+            "INSERT INTO lease (name, holder, expires) VALUES (?,?,?) ON CONFLICT (name) DO UPDATE SET "
+            "holder=excluded.holder, expires=excluded.expires WHERE lease.holder=excluded.holder OR lease.expires<?;",
+            (name, holder, now + ttl, now)
+        )
+    return cursor.rowcount == 1
+
+
+@timed
+def get_lease(name: str):
+    with db.connection:
+        cursor = db.connection.cursor()
+        retrieve = cursor.execute(
+            "SELECT holder, expires FROM lease WHERE name=?;", (name,)
+        ).fetchone()
+    return retrieve
+
+
+@timed
+def get_alert_states(frequency: int, zipcodes: list, now: float) -> set:
+    """Returns the (zipcode, digest) pairs of alerts already sent at this frequency that have not expired."""
+    with db.connection:
+        cursor = db.connection.cursor()
+        known = cursor.execute(
+            "SELECT zipcode, digest FROM alert_state WHERE frequency=? AND expires>=? "
+            "AND zipcode IN (SELECT value FROM json_each(?));", (frequency, now, json.dumps(list(zipcodes)))
+        ).fetchall()
+    return set(known)
+
+
+@timed
+def put_alert_states(frequency: int, states: list, now: float):
+    """Records (zipcode, digest, expires) alert states once they have been sent, extending those seen before.
+
+    Expired states are purged so an alert that reappears after it lapsed is treated as new.
+    """
+    with db.connection:
+        cursor = db.connection.cursor()
+        cursor.execute("DELETE FROM alert_state WHERE expires<?;", (now,))
+        cursor.executemany(
+            "INSERT INTO alert_state (zipcode, frequency, digest, expires) VALUES (?,?,?,?) "
+            "ON CONFLICT (zipcode, frequency, digest) DO UPDATE SET expires=MAX(expires, excluded.expires);",
+            [(zipcode, frequency, digest, expires) for zipcode, digest, expires in states]
+        )
+
+
+def iter_subscribers(columns: tuple = user_data.user_input, condition: str = "1", params: tuple = ()):
+    """Streams subscribers page by page with keyset pagination on (email_address, zipcode).
+
+    Only the requested columns are read, so password blobs stay on disk unless they are asked for.
+    """
+    after = ("", 0)
+    while True:
+        with timer("iter_subscribers"), db.connection:
+            cursor = db.connection.cursor()
+            page = cursor.execute(
+                f"SELECT {', '.join(columns)}, email_address, zipcode FROM container WHERE ({condition}) "
+                "AND (email_address, zipcode) > (?, ?) ORDER BY email_address, zipcode LIMIT ?;",
+                (*params, *after, constants.page_size)
+            ).fetchall()
+        for row in page:
+            yield row[:-2]
+        if len(page) < constants.page_size:
+            return
+        after = page[-1][-2:]
+
+
+def iter_report_subscribers(report_time: str, columns: tuple = user_data.user_input):
+    """Subscribers due for a report at the given time."""
+    return iter_subscribers(columns, "report_time=?", (report_time,))
+
+
+def iter_alert_subscribers(frequency: int, zipcodes: list, columns: tuple = user_data.user_input):
+    """Subscribers in the zipcodes whose alert frequency matches, falling back to the default frequency."""
+    return iter_subscribers(
+        columns, "COALESCE(NULLIF(frequency, 0), ?)=? AND zipcode IN (SELECT value FROM json_each(?))",
+        (constants.alert_frequency, frequency, json.dumps(list(zipcodes)))
+    )
+
+
+def iter_crowd_subscribers(zipcodes: list, columns: tuple = user_data.user_input):
+    """Subscribers in the zipcodes who accept crowd casts."""
+    return iter_subscribers(
+        columns, "crowdsource_button=1 AND zipcode IN (SELECT value FROM json_each(?))", (json.dumps(list(zipcodes)),)
+    )
+
+
+@timed
+def get_crowd_userids(userids: set) -> set:
+    """The userids among the given ones that accept crowd casts on any of their subscriptions."""
     with db.connection:
         cursor = db.connection.cursor()
         retrieve = cursor.execute(
-            "SELECT * FROM container"
+            "SELECT DISTINCT userid FROM container WHERE crowdsource_button=1 "
+            "AND userid IN (SELECT value FROM json_each(?));", (json.dumps(list(userids)),)
+        ).fetchall()
+    return {each[0] for each in retrieve}
+
+
+@timed
+def get_report_zipcodes(report_time: str) -> list:
+    with db.connection:
+        cursor = db.connection.cursor()
+        retrieve = cursor.execute(
+            "SELECT DISTINCT zipcode FROM container WHERE report_time=?;", (report_time,)
+        ).fetchall()
+    return [each[0] for each in retrieve]
+
+
+@timed
+def get_alert_zipcodes(frequency: int) -> list:
+    with db.connection:
+        cursor = db.connection.cursor()
+        retrieve = cursor.execute(
+            "SELECT DISTINCT zipcode FROM container WHERE COALESCE(NULLIF(frequency, 0), ?)=?;",
+            (constants.alert_frequency, frequency)
+        ).fetchall()
+    return [each[0] for each in retrieve]
+
+
+@timed
+def get_schedule():
+    with db.connection:
+        cursor = db.connection.cursor()
+        retrieve = cursor.execute(
+            "SELECT DISTINCT report_time, frequency FROM container"
         ).fetchall()
     return retrieve
+
+
+@timed
+def get_zipcodes():
+    with db.connection:
+        cursor = db.connection.cursor()
+        retrieve = cursor.execute(
+            "SELECT DISTINCT zipcode FROM container"
+        ).fetchall()
+    return [each[0] for each in retrieve]
+
+
+@timed
+def has_zipcode(zipcode: int) -> bool:
+    with db.connection:
+        cursor = db.connection.cursor()
+        retrieve = cursor.execute(
+            "SELECT 1 FROM container WHERE zipcode=? LIMIT 1;", (zipcode,)
+        ).fetchone()
+    return bool(retrieve)
+
+
+@timed
+def get_coordinates():
+    """Loads the stored zipcode centroids, importing the offline zipcode file first when it is new or has changed."""
+    with db.connection:
+        cursor = db.connection.cursor()
+        if os.path.isfile(constants.zipcode_file):
+            status = os.stat(constants.zipcode_file)
+            signature = f"{status.st_size}:{status.st_mtime_ns}"
+            imported = cursor.execute(
+                "SELECT signature FROM imports WHERE name=?;", (constants.zipcode_file,)
+            ).fetchone()
+            if not imported or imported[0] != signature:
+                with open(constants.zipcode_file, newline="") as file:
+                    cursor.executemany(
+                        "INSERT or REPLACE INTO coordinates (zipcode, latitude, longitude) VALUES (?,?,?);",
+                        ((int(row[0]), float(row[1]), float(row[2]))
+                         for row in csv.reader(file) if row and row[0].strip().isdigit())
+                    )
+                cursor.execute("INSERT or REPLACE INTO imports (name, signature) VALUES (?,?);",
+                               (constants.zipcode_file, signature))
+        retrieve = cursor.execute(
+            "SELECT zipcode, latitude, longitude FROM coordinates"
+        ).fetchall()
+    return {zipcode: (latitude, longitude) for zipcode, latitude, longitude in retrieve}
+
+
+@timed
+def find_coordinates(zipcode: int):
+    with db.connection:
+        cursor = db.connection.cursor()
+        retrieve = cursor.execute(
+            "SELECT latitude, longitude FROM coordinates WHERE zipcode=?;", (zipcode,)
+        ).fetchone()
+    return retrieve
+
+
+@timed
+def put_coordinates(zipcode: int, latitude: float, longitude: float):
+    with db.connection:
+        cursor = db.connection.cursor()
+        cursor.execute(
+            "INSERT or REPLACE INTO coordinates (zipcode, latitude, longitude) VALUES (?,?,?);",
+            (zipcode, latitude, longitude)
+        )
+
+
+@timed
+def put_emails(messages: list):
+    """Queues (recipient, subject, body, attachment) tuples for the mailer in a single transaction."""
+    with db.connection:
+        cursor = db.connection.cursor()
+        cursor.executemany(
+            "INSERT INTO outbox (recipient, subject, body, attachment) VALUES (?,?,?,?);", messages
+        )
+
+
+@timed
+def claim_email(now: float):
+    """Atomically marks the oldest available queued email as sending and returns it.
+
+    While an email is sending, its available column holds the time it was claimed.
+    """
+    with db.connection:
+        cursor = db.connection.cursor()
+        retrieve = cursor.execute(
+            "UPDATE outbox SET status='sending', available=? WHERE id=(SELECT id FROM outbox WHERE status='queued' "
+            "AND available<=? ORDER BY id LIMIT 1) RETURNING id, recipient, subject, body, attachment, attempts;",
+            (now, now)
+        ).fetchone()
+    return retrieve
+
+
+@timed
+def update_email(email_id: int, status: str, attempts: int = 0, available: float = 0, error: str = None):
+    with db.connection:
+        cursor = db.connection.cursor()
+        if status == "sent":
+            cursor.execute("DELETE FROM outbox WHERE id=?;", (email_id,))
+        else:
+            cursor.execute(
+                "UPDATE outbox SET status=?, attempts=?, available=?, error=? WHERE id=?;",
+                (status, attempts, available, error, email_id)
+            )
+
+
+@timed
+def reset_emails(claimed_before: float) -> int:
+    """Requeues emails left in sending state by a mailer that stopped mid-send.
+
+    Only emails claimed before the given time are reset, so sends in progress in other workers are left alone.
+    """
+    with db.connection:
+        cursor = db.connection.cursor()
+        cursor.execute("UPDATE outbox SET status='queued' WHERE status='sending' AND available<?;", (claimed_before,))
+    return cursor.rowcount